@@ -1,10 +1,14 @@
-from fastapi import APIRouter, HTTPException, Depends
-from typing import List, Dict, Any, Tuple
+from fastapi import APIRouter, HTTPException, Depends, Response
+from typing import List, Dict, Any, Tuple, Optional
 import httpx
 from app.core.config import settings
 from app.core.auth import get_current_active_session
-from app.utils.spotify_utils import fetch_all_liked_tracks
-from app.core.redis import get_top_albums_cache, set_top_albums_cache
+from app.utils.spotify_utils import fetch_all_liked_tracks, load_stale_or_unavailable
+from app.core.redis import (
+    get_top_albums_cache, set_top_albums_cache, get_stale_top_albums_cache, get_stale_user_tracks_cache
+)
+from app.core.circuit_breaker import UpstreamUnavailableError
+from app.core.timing import timed
 
 router = APIRouter()
 
@@ -61,8 +65,36 @@ def _organize_tracks_by_albums(tracks_data: List[Dict[str, Any]]) -> List[Tuple[
     # Convert to list of tuples
     return list(album_dict.items())
 
+def build_top_albums(tracks_data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Build the top albums list from liked tracks"""
+    albums_organized_list = _organize_tracks_by_albums(tracks_data)
+
+    # Sort albums by saved_track_count (desc) and then album_key (asc)
+    sorted_albums_with_key = sorted(
+        albums_organized_list, 
+        key=lambda item_tuple: (-item_tuple[1]['saved_track_count'], item_tuple[0])
+    )
+    
+    # Limit to TOP_ALBUMS_COUNT
+    return [
+        album_data_dict 
+        for _album_key, album_data_dict in sorted_albums_with_key[:settings.TOP_ALBUMS_COUNT]
+    ]
+
+def _get_stale_top_albums(app_session_token: str) -> Optional[Tuple[List[Dict[str, Any]], int]]:
+    """Helper to get stale top albums as (data, age_seconds), rebuilt from the stale library if their own copy is gone"""
+    stale_entry = get_stale_top_albums_cache(app_session_token)
+    if stale_entry is not None:
+        return stale_entry
+    stale_tracks_entry = get_stale_user_tracks_cache(app_session_token)
+    if stale_tracks_entry is None:
+        return None
+    stale_tracks, age_seconds = stale_tracks_entry
+    return build_top_albums(stale_tracks), age_seconds
+
 @router.get("/top", response_model=List[Dict[str, Any]])
 async def get_top_albums_from_liked_songs(
+    response: Response,
     current_session: dict = Depends(get_current_active_session)
 ):
     """Get user's top albums derived from their liked/saved songs."""
@@ -83,28 +115,23 @@ async def get_top_albums_from_liked_songs(
         if not liked_tracks:
             return [] 
 
-        # 3. Organize tracks by album
-        albums_organized_list = _organize_tracks_by_albums(liked_tracks)
-        if not albums_organized_list:
+        # 3. Organize, sort and limit albums
+        with timed("aggregate"):
+            top_n_albums_data = build_top_albums(liked_tracks)
+        if not top_n_albums_data:
             return []
 
-        # 4. Sort albums by saved_track_count (desc) and then album_key (asc)
-        sorted_albums_with_key = sorted(
-            albums_organized_list, 
-            key=lambda item_tuple: (-item_tuple[1]['saved_track_count'], item_tuple[0])
-        )
-        
-        # Limit to TOP_ALBUMS_COUNT
-        top_n_albums_data = [
-            album_data_dict 
-            for _album_key, album_data_dict in sorted_albums_with_key[:settings.TOP_ALBUMS_COUNT]
-        ]
-
-        # 5. Cache the result
+        # 4. Cache the result
         set_top_albums_cache(app_session_token, top_n_albums_data, settings.USER_CACHE_TTL_SECONDS)
         
         return top_n_albums_data
 
+    except UpstreamUnavailableError as upstream_exc:
+        stale_top_albums, stale_headers = load_stale_or_unavailable(
+            _get_stale_top_albums, app_session_token, upstream_exc, "get_top_albums_from_liked_songs"
+        )
+        response.headers.update(stale_headers)
+        return stale_top_albums
     except HTTPException as http_exc:
         raise http_exc
     except Exception as e:
@@ -1,11 +1,15 @@
-from fastapi import APIRouter, HTTPException, Depends
-from typing import List, Dict, Any, Tuple
+from fastapi import APIRouter, HTTPException, Depends, Response
+from typing import List, Dict, Any, Tuple, Optional
 from collections import OrderedDict
 import httpx
 from app.core.config import settings
 from app.core.auth import get_current_active_session
-from app.utils.spotify_utils import fetch_all_liked_tracks
-from app.core.redis import get_top_artists_cache, set_top_artists_cache
+from app.utils.spotify_utils import fetch_all_liked_tracks, load_stale_or_unavailable
+from app.core.redis import (
+    get_top_artists_cache, set_top_artists_cache, get_stale_top_artists_cache, get_stale_user_tracks_cache
+)
+from app.core.circuit_breaker import UpstreamUnavailableError
+from app.core.timing import timed
 
 router = APIRouter()
 
@@ -38,8 +42,35 @@ def _organize_tracks_by_artist(tracks_data: List[Dict[str, Any]]) -> Dict[str, D
     
     return artist_songs
 
+def build_top_artists(tracks_data: List[Dict[str, Any]]) -> List[Tuple[str, int]]:
+    """Build the (artist_name, song_count) top artists list from liked tracks"""
+    artist_tracks_aggregation = _organize_tracks_by_artist(tracks_data)
+
+    # Create a list of (artist_name, song_count)
+    artist_song_counts = [
+        (artist, data['count']) 
+        for artist, data in artist_tracks_aggregation.items()
+    ]
+    
+    # Sort: primary key is count (desc), secondary is artist name (asc)
+    sorted_artists = sorted(artist_song_counts, key=lambda x: (-x[1], x[0]))
+    
+    return sorted_artists[:settings.TOP_ARTISTS_COUNT]
+
+def _get_stale_top_artists(app_session_token: str) -> Optional[Tuple[List[Tuple[str, int]], int]]:
+    """Helper to get stale top artists as (data, age_seconds), rebuilt from the stale library if their own copy is gone"""
+    stale_entry = get_stale_top_artists_cache(app_session_token)
+    if stale_entry is not None:
+        return stale_entry
+    stale_tracks_entry = get_stale_user_tracks_cache(app_session_token)
+    if stale_tracks_entry is None:
+        return None
+    stale_tracks, age_seconds = stale_tracks_entry
+    return build_top_artists(stale_tracks), age_seconds
+
 @router.get("/top", response_model=List[Tuple[str, int]])
 async def get_top_artists_from_liked_songs(
+    response: Response,
     current_session: dict = Depends(get_current_active_session)
 ):
     """Get user's top artists from their liked/saved songs"""
@@ -60,28 +91,23 @@ async def get_top_artists_from_liked_songs(
         if not liked_tracks:
             return [] 
 
-        # 3. Organize tracks by artist
-        artist_tracks_aggregation = _organize_tracks_by_artist(liked_tracks)
-        if not artist_tracks_aggregation:
+        # 3. Organize, sort and limit artists
+        with timed("aggregate"):
+            top_n_artists = build_top_artists(liked_tracks)
+        if not top_n_artists:
             return []
 
-        # 4. Sort artists by song count and name, then limit
-        # Create a list of (artist_name, song_count)
-        artist_song_counts = [
-            (artist, data['count']) 
-            for artist, data in artist_tracks_aggregation.items()
-        ]
-        
-        # Sort: primary key is count (desc), secondary is artist name (asc)
-        sorted_artists = sorted(artist_song_counts, key=lambda x: (-x[1], x[0]))
-        
-        top_n_artists = sorted_artists[:settings.TOP_ARTISTS_COUNT]
-
-        # 5. Cache the result
+        # 4. Cache the result
         set_top_artists_cache(app_session_token, top_n_artists, settings.USER_CACHE_TTL_SECONDS)
         
         return top_n_artists
 
+    except UpstreamUnavailableError as upstream_exc:
+        stale_top_artists, stale_headers = load_stale_or_unavailable(
+            _get_stale_top_artists, app_session_token, upstream_exc, "get_top_artists_from_liked_songs"
+        )
+        response.headers.update(stale_headers)
+        return stale_top_artists
     except HTTPException as http_exc: # Re-raise if fetch_all_liked_tracks raised one
         raise http_exc
     except Exception as e:
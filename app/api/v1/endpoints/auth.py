@@ -3,11 +3,18 @@ import json
 import time
 import uuid
 from app.core.config import settings
-from app.core.redis import set_session_data
+from app.core.redis import set_session_data, get_session_data
 from fastapi import APIRouter, HTTPException, Request
 from fastapi.responses import Response, JSONResponse, RedirectResponse
 from app.core.auth import get_current_active_session
+from app.utils.spotify_utils import fetch_user_ref
 from app.core.redis import delete_session_data
+from app.core.snapshot_store import delete_library_snapshot
+from app.core.rate_limiter import acquire_spotify_quota, QuotaExceededError
+from app.core.session_tokens import (
+    SESSION_COOKIE_NAME, REISSUED_COOKIE_SCOPE_KEY,
+    is_stateless_mode, issue_session_token, set_session_cookie, forget_session
+)
 from typing import Dict
 from fastapi import Depends
 
@@ -94,6 +101,7 @@ async def callback(request: Request, code: str, state: str, error: str = None):
     try:
         async with httpx.AsyncClient() as client:
             # Exchange code for access token
+            await acquire_spotify_quota()
             token_response = await client.post(
                 settings.TOKEN_URL,
                 data={
@@ -124,6 +132,10 @@ async def callback(request: Request, code: str, state: str, error: str = None):
                 "spotify_access_token_expires_at": spotify_access_token_expires_at
             }
 
+            # Link the session to the user's library snapshot, which outlives sessions and Redis restarts
+            if settings.SNAPSHOT_STORE_ENABLED:
+                session_payload["user_ref"] = await fetch_user_ref(spotify_access_token)
+
             if not set_session_data(app_session_token, session_payload):
                 print(f"Failed to set session data for app_session_token: {app_session_token}")
                 raise HTTPException(status_code=500, detail="Could not save session data")
@@ -131,15 +143,14 @@ async def callback(request: Request, code: str, state: str, error: str = None):
             redirect_response = RedirectResponse(url=target_final_redirect_uri)
 
             # 4. Set the app_session_token cookie
-            redirect_response.set_cookie(
-                key = "app_session_token",
-                value = app_session_token,
-                httponly = True,
-                secure = settings.API_ENV != "development", 
-                samesite= "lax",
-                max_age = settings.SESSION_TIMEOUT,
-                path = "/"
-            )
+            # In stateless mode it carries the access token so most requests skip Redis
+            if is_stateless_mode():
+                session_cookie_value = issue_session_token(
+                    app_session_token, spotify_access_token, spotify_access_token_expires_at
+                )
+            else:
+                session_cookie_value = app_session_token
+            set_session_cookie(redirect_response, session_cookie_value)
 
             redirect_response.delete_cookie(
                 "spotify_oauth_state",
@@ -151,6 +162,9 @@ async def callback(request: Request, code: str, state: str, error: str = None):
 
             # 5. Redirect to the final redirect URI
             return redirect_response
+    except QuotaExceededError as exc:
+        print(f"Spotify token exchange not admitted: {exc}")
+        raise HTTPException(status_code=503, detail="Spotify is busy, please try logging in again shortly")
     except httpx.RequestError as exc:
         print(f"HTTP request error: {exc}")
         raise HTTPException(status_code=502, detail="Error communicating with Spotify")
@@ -165,12 +179,15 @@ async def read_users_me(current_session: dict = Depends(get_current_active_sessi
     return {"status": "authenticated", "app_session_token_suffix": current_session.get("app_session_token", "")[-4:]}
 
 @router.post("/logout") 
-async def logout_user(response: Response, current_session: dict = Depends(get_current_active_session)):
+async def logout_user(request: Request, response: Response, current_session: dict = Depends(get_current_active_session)):
     """Logout user by deleting session from Redis and clearing the cookie."""
     app_session_token = current_session.get("app_session_token")
     
     if app_session_token:
+        delete_library_snapshot(get_session_data(app_session_token, "user_ref"))
+        # Deleting the Redis session also revokes stateless session cookies
         deleted_count = delete_session_data(app_session_token)
+        forget_session(app_session_token)
         if deleted_count > 0:
             print(f"Session {app_session_token[:4]}...{app_session_token[-4:]} deleted from Redis.")
         else:
@@ -181,9 +198,12 @@ async def logout_user(response: Response, current_session: dict = Depends(get_cu
 
     response = JSONResponse(content={"message": "Logout successful"}, status_code=200)
 
+    # Don't let a cookie re-issued during this request's token refresh log the user back in
+    request.scope.pop(REISSUED_COOKIE_SCOPE_KEY, None)
+
     # Clear the app_session_token cookie from the browser
     response.delete_cookie(
-        key="app_session_token",
+        key=SESSION_COOKIE_NAME,
         path="/", 
         secure=settings.API_ENV != "development", 
         httponly=True, 
@@ -0,0 +1,128 @@
+from fastapi import APIRouter, HTTPException, Depends, Response, Query
+from typing import List, Dict, Any
+from app.core.config import settings
+from app.core.auth import get_current_active_session
+from app.utils.spotify_utils import fetch_all_liked_tracks, load_stale_or_unavailable
+from app.core.redis import (
+    get_top_artists_cache, set_top_artists_cache,
+    get_top_albums_cache, set_top_albums_cache,
+    get_stale_user_tracks_cache
+)
+from app.core.circuit_breaker import UpstreamUnavailableError
+from app.core.timing import timed
+from app.api.v1.endpoints.artists import build_top_artists
+from app.api.v1.endpoints.albums import build_top_albums
+
+router = APIRouter()
+
+DASHBOARD_SECTIONS = ("summary", "artists", "albums")
+
+def _build_summary(tracks_data: List[Dict[str, Any]]) -> Dict[str, int]:
+    """Helper to count saved tracks, distinct artists and distinct albums in one pass"""
+    artist_names = set()
+    album_ids = set()
+    total_tracks = 0
+
+    for track_obj in tracks_data:
+        track = track_obj.get('track')
+        if not track or not isinstance(track, dict):
+            continue
+        total_tracks += 1
+
+        for artist in track.get('artists', []):
+            if artist.get('name'):
+                artist_names.add(artist['name'])
+
+        album = track.get('album')
+        if isinstance(album, dict) and album.get('id'):
+            album_ids.add(album['id'])
+
+    return {
+        'total_tracks': total_tracks,
+        'total_artists': len(artist_names),
+        'total_albums': len(album_ids),
+    }
+
+def _parse_sections(sections: str) -> List[str]:
+    """Helper to validate the sections= query parameter"""
+    requested = [section.strip() for section in sections.split(',') if section.strip()]
+    unknown = [section for section in requested if section not in DASHBOARD_SECTIONS]
+    if unknown or not requested:
+        raise HTTPException(
+            status_code=400,
+            detail=f"sections must be a comma-separated subset of: {', '.join(DASHBOARD_SECTIONS)}",
+        )
+    return requested
+
+@router.get("", response_model=Dict[str, Any])
+async def get_dashboard(
+    response: Response,
+    sections: str = Query(",".join(DASHBOARD_SECTIONS), description="Comma-separated sections: summary, artists, albums"),
+    current_session: dict = Depends(get_current_active_session)
+):
+    """Get summary counts, top artists and top albums computed from a single library load."""
+    app_session_token = current_session.get("app_session_token")
+    spotify_access_token = current_session.get("spotify_access_token")
+
+    if not app_session_token or not spotify_access_token:
+        raise HTTPException(status_code=401, detail="Invalid session data")
+
+    requested_sections = _parse_sections(sections)
+    dashboard = {}
+
+    # 1. Check caches for the derived views
+    if "artists" in requested_sections:
+        cached_top_artists = get_top_artists_cache(app_session_token)
+        if cached_top_artists is not None:
+            dashboard['top_artists'] = cached_top_artists
+    if "albums" in requested_sections:
+        cached_top_albums = get_top_albums_cache(app_session_token)
+        if cached_top_albums is not None:
+            dashboard['top_albums'] = cached_top_albums
+
+    needs_library = (
+        "summary" in requested_sections
+        or ("artists" in requested_sections and 'top_artists' not in dashboard)
+        or ("albums" in requested_sections and 'top_albums' not in dashboard)
+    )
+    if not needs_library:
+        return dashboard
+
+    try:
+        # 2. Load the library once for every section that still needs it
+        is_stale = False
+        try:
+            liked_tracks = await fetch_all_liked_tracks(spotify_access_token, app_session_token)
+        except UpstreamUnavailableError as upstream_exc:
+            liked_tracks, stale_headers = load_stale_or_unavailable(
+                get_stale_user_tracks_cache, app_session_token, upstream_exc, "get_dashboard"
+            )
+            is_stale = True
+            response.headers.update(stale_headers)
+
+        # 3. Compute the missing sections
+        if "summary" in requested_sections:
+            with timed("aggregate"):
+                dashboard['summary'] = _build_summary(liked_tracks)
+
+        if "artists" in requested_sections and 'top_artists' not in dashboard:
+            with timed("aggregate"):
+                top_n_artists = build_top_artists(liked_tracks)
+            if top_n_artists and not is_stale:
+                set_top_artists_cache(app_session_token, top_n_artists, settings.USER_CACHE_TTL_SECONDS)
+            dashboard['top_artists'] = top_n_artists
+
+        if "albums" in requested_sections and 'top_albums' not in dashboard:
+            with timed("aggregate"):
+                top_n_albums_data = build_top_albums(liked_tracks)
+            if top_n_albums_data and not is_stale:
+                set_top_albums_cache(app_session_token, top_n_albums_data, settings.USER_CACHE_TTL_SECONDS)
+            dashboard['top_albums'] = top_n_albums_data
+
+        return dashboard
+
+    except HTTPException as http_exc:
+        raise http_exc
+    except Exception as e:
+        print(f"Unexpected error in get_dashboard: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error building dashboard from liked songs.")
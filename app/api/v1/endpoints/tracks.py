@@ -1,14 +1,78 @@
-from fastapi import APIRouter, HTTPException, Depends
-from typing import List, Dict, Any
+from fastapi import APIRouter, HTTPException, Depends, Query
+from fastapi.responses import Response
+from functools import lru_cache
+from typing import List, Dict, Any, Optional
+import asyncio
+import json
 from app.core.config import settings
 from app.core.auth import get_current_active_session
-from app.utils.spotify_utils import fetch_all_liked_tracks
+from app.utils.spotify_utils import fetch_all_liked_tracks, load_stale_or_unavailable
+from app.utils.search_index import load_library_index, refresh_library_index, build_index, search
+from app.core.redis import (
+    get_user_tracks_projection_cache, set_user_tracks_projection_cache,
+    get_stale_user_tracks_cache, get_user_tracks_version
+)
+from app.core.circuit_breaker import UpstreamUnavailableError
+from app.core.timing import timed
 
 router = APIRouter()
 
+@lru_cache(maxsize=128)
+def _parse_fields(fields: str) -> Dict[str, Any]:
+    """Helper to turn a fields= spec into a nested projection tree.
+
+    "track.id,track.artists.name" -> {"track": {"id": {}, "artists": {"name": {}}}}
+    An empty subtree means "keep the whole value", so "track,track.id" keeps all of track.
+    """
+    paths = []
+    for path in fields.split(','):
+        path = path.strip()
+        if not path:
+            continue
+        parts = [part.strip() for part in path.split('.')]
+        if not all(parts):
+            raise HTTPException(status_code=400, detail=f"Invalid field path: {path}")
+        paths.append(parts)
+
+    tree = {}
+    # Shorter paths first: once a path ends at a node, deeper paths under it are ignored
+    for parts in sorted(paths, key=len):
+        node = tree
+        for depth, part in enumerate(parts):
+            is_leaf = depth == len(parts) - 1
+            if part in node and not node[part]:
+                break
+            if is_leaf:
+                node[part] = {}
+            else:
+                node = node.setdefault(part, {})
+    if not tree:
+        raise HTTPException(status_code=400, detail="fields must name at least one field")
+    return tree
+
+def _project(value: Any, tree: Dict[str, Any]) -> Any:
+    """Helper to apply a projection tree to a Spotify object. Lists are projected item by item."""
+    if not tree:
+        return value
+    if isinstance(value, list):
+        return [_project(item, tree) for item in value]
+    if isinstance(value, dict):
+        return {key: _project(value[key], subtree) for key, subtree in tree.items() if key in value}
+    return value
+
+def _normalize_fields(fields: str) -> str:
+    """Helper to get a canonical fields= spec so equivalent projections share a cache entry"""
+    return ','.join(sorted({path.strip() for path in fields.split(',') if path.strip()}))
+
 @router.get("/liked", response_model=List[Dict[str, Any]])
-async def get_liked_tracks(current_session: dict = Depends(get_current_active_session)):
-    """Get user's liked tracks"""
+async def get_liked_tracks(
+    fields: Optional[str] = Query(
+        None,
+        description="Comma-separated dotted paths to keep from each saved track, e.g. track.id,track.name,track.artists.name,track.album.name",
+    ),
+    current_session: dict = Depends(get_current_active_session)
+):
+    """Get user's liked tracks, optionally trimmed to the requested fields"""
     try:
         app_session_token = current_session.get("app_session_token")
         spotify_access_token = current_session.get("spotify_access_token")
@@ -16,11 +80,93 @@ async def get_liked_tracks(current_session: dict = Depends(get_current_active_se
         if not app_session_token or not spotify_access_token:
             raise HTTPException(status_code=401, detail="Invalid session data")
 
-        liked_tracks = await fetch_all_liked_tracks(spotify_access_token, app_session_token)
-        return liked_tracks
+        normalized_fields = None
+        projection = None
+        if fields is not None:
+            normalized_fields = _normalize_fields(fields)
+            projection = _parse_fields(normalized_fields)
+
+        # 1. Check cache for this projection
+        if normalized_fields:
+            cached_payload = get_user_tracks_projection_cache(app_session_token, normalized_fields)
+            if cached_payload is not None:
+                return Response(content=cached_payload, media_type="application/json")
+
+        stale_headers = None
+        try:
+            liked_tracks = await fetch_all_liked_tracks(spotify_access_token, app_session_token)
+        except UpstreamUnavailableError as upstream_exc:
+            liked_tracks, stale_headers = load_stale_or_unavailable(
+                get_stale_user_tracks_cache, app_session_token, upstream_exc, "get_liked_tracks endpoint"
+            )
+
+        # 2. Serialize once ourselves instead of letting the response model re-validate every track
+        with timed("serialize"):
+            if projection is None:
+                payload = json.dumps(liked_tracks, separators=(',', ':'))
+            else:
+                payload = json.dumps([_project(track_obj, projection) for track_obj in liked_tracks], separators=(',', ':'))
+
+        if projection is None:
+            return Response(content=payload, media_type="application/json", headers=stale_headers)
+
+        # 3. Cache the projection (never cache projections of stale data)
+        if stale_headers is None:
+            set_user_tracks_projection_cache(
+                app_session_token, normalized_fields, payload, settings.LIKED_TRACKS_PROJECTION_CACHE_MAX
+            )
+
+        return Response(content=payload, media_type="application/json", headers=stale_headers)
     except HTTPException as http_exc:
         print(f"HTTP error in get_liked_tracks endpoint: {str(http_exc)}")
         raise http_exc
     except Exception as e:
         print(f"Unexpected error in get_liked_tracks endpoint: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"An unexpected error occurred while fetching liked tracks.") 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"An unexpected error occurred while fetching liked tracks.")
+
+@router.get("/search", response_model=List[Dict[str, Any]])
+async def search_liked_tracks(
+    response: Response,
+    q: str = Query(..., min_length=1, description="Track, artist or album name, or a prefix of one. Tolerates typos."),
+    limit: int = Query(20, ge=1, le=settings.SEARCH_RESULTS_LIMIT),
+    current_session: dict = Depends(get_current_active_session)
+):
+    """Search the user's liked tracks by track, artist or album name"""
+    app_session_token = current_session.get("app_session_token")
+    spotify_access_token = current_session.get("spotify_access_token")
+
+    if not app_session_token or not spotify_access_token:
+        raise HTTPException(status_code=401, detail="Invalid session data")
+
+    try:
+        # 1. Use the stored index while it was built from the currently cached library
+        index = None
+        current_version = get_user_tracks_version(app_session_token)
+        if current_version is not None:
+            index = load_library_index(app_session_token)
+            if index is not None and index["version"] != current_version:
+                index = None
+
+        # 2. First search, or the library was reloaded since: (re)build the index lazily, off the event loop
+        if index is None:
+            try:
+                liked_tracks = await fetch_all_liked_tracks(spotify_access_token, app_session_token)
+                with timed("search_index"):
+                    index = await asyncio.get_running_loop().run_in_executor(
+                        None, refresh_library_index, app_session_token, liked_tracks
+                    )
+            except UpstreamUnavailableError as upstream_exc:
+                stale_tracks, stale_headers = load_stale_or_unavailable(
+                    get_stale_user_tracks_cache, app_session_token, upstream_exc, "search_liked_tracks"
+                )
+                with timed("search_index"):
+                    index = await asyncio.get_running_loop().run_in_executor(None, build_index, stale_tracks)
+                response.headers.update(stale_headers)
+
+        with timed("search"):
+            return search(index, q, limit)
+    except HTTPException as http_exc:
+        raise http_exc
+    except Exception as e:
+        print(f"Unexpected error in search_liked_tracks endpoint: {str(e)}")
+        raise HTTPException(status_code=500, detail="An unexpected error occurred while searching liked tracks.")
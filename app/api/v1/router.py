@@ -7,7 +7,7 @@ import time
 
 from app.core.config import settings
 from app.core.redis import get_session_data, set_session_data
-from app.api.v1.endpoints import auth, tracks, artists, albums
+from app.api.v1.endpoints import auth, tracks, artists, albums, dashboard
 
 api_router = APIRouter()
 
@@ -15,4 +15,5 @@ api_router = APIRouter()
 api_router.include_router(auth.router, prefix="/auth", tags=["Authentication"])
 api_router.include_router(tracks.router, prefix="/tracks", tags=["Tracks"])
 api_router.include_router(artists.router, prefix="/artists", tags=["Artists"])
-api_router.include_router(albums.router, prefix="/albums", tags=["Albums"]) 
\ No newline at end of file
+api_router.include_router(albums.router, prefix="/albums", tags=["Albums"])
+api_router.include_router(dashboard.router, prefix="/dashboard", tags=["Dashboard"]) 
\ No newline at end of file
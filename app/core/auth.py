@@ -1,6 +1,13 @@
 from fastapi import Depends, HTTPException, status, Request
 from app.core.config import settings
 from app.core.redis import get_session_data, set_session_data 
+from app.core.circuit_breaker import get_circuit_breaker, is_upstream_failure
+from app.core.rate_limiter import acquire_spotify_quota, drain_spotify_quota, QuotaExceededError
+from app.core.timing import timed, timed_function
+from app.core.session_tokens import (
+    SESSION_COOKIE_NAME, REISSUED_COOKIE_SCOPE_KEY,
+    is_stateless_mode, issue_session_token, decode_session_token, is_session_revoked
+)
 import httpx
 import time
 import uuid
@@ -8,35 +15,78 @@ from typing import Optional
 
 # Dependency 
 async def get_current_active_session(request: Request) -> dict:
-    app_session_token = request.cookies.get("app_session_token")
-    if not app_session_token:
+    session_cookie = request.cookies.get(SESSION_COOKIE_NAME)
+    if not session_cookie:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Not authenticated - missing session token",
             headers={"WWW-Authenticate": "Bearer"}, 
         )
 
-    session_data = get_session_data(app_session_token)
+    current_time = int(time.time())
+    
+    # Buffer time before actual expiry to trigger refresh
+    buffer_time_seconds = 300 
+
+    if is_stateless_mode():
+        # The cookie itself carries the access token, Redis is only needed to refresh it
+        with timed("session"):
+            claims = decode_session_token(session_cookie)
+            if claims is None:
+                raise HTTPException(
+                    status_code=status.HTTP_401_UNAUTHORIZED,
+                    detail="Invalid or expired session",
+                )
+            app_session_token = claims["sid"]
+
+            if claims["sat_exp"] >= (current_time + buffer_time_seconds):
+                if is_session_revoked(app_session_token):
+                    raise HTTPException(
+                        status_code=status.HTTP_401_UNAUTHORIZED,
+                        detail="Invalid or expired session",
+                    )
+                return {
+                    "app_session_token": app_session_token,
+                    "spotify_access_token": claims["sat"],
+                    "spotify_access_token_expires_at": claims["sat_exp"],
+                }
+    else:
+        app_session_token = session_cookie
+
+    with timed("session"):
+        session_data = get_session_data(app_session_token)
 
-    session_data["app_session_token"] = app_session_token
     if not session_data:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid or expired session",
         )
+    session_data["app_session_token"] = app_session_token
     
     spotify_access_token_expires_at = session_data.get("spotify_access_token_expires_at", 0)
-    current_time = int(time.time())
-    
-    # Buffer time before actual expiry to trigger refresh
-    buffer_time_seconds = 300 
 
     if spotify_access_token_expires_at < (current_time + buffer_time_seconds):
         
         print(f"Spotify token for session {app_session_token[:4]}...{app_session_token[-4:]} expired or expiring soon. Refreshing...")
-        new_spotify_tokens = await refresh_spotify_token(session_data.get("spotify_refresh_token"))
+        refresh_not_admitted = False
+        try:
+            new_spotify_tokens = await refresh_spotify_token(session_data.get("spotify_refresh_token"))
+        except QuotaExceededError as exc:
+            # Our own back-pressure, says nothing about the refresh token being bad
+            print(f"Spotify token refresh not admitted for session {app_session_token[:4]}...{app_session_token[-4:]}: {str(exc)}")
+            new_spotify_tokens = None
+            refresh_not_admitted = True
         
         if not new_spotify_tokens:
+            # Spotify accounts is unhealthy but the current token still works, keep using it
+            if spotify_access_token_expires_at > current_time:
+                print(f"Spotify token refresh failed for session {app_session_token[:4]}...{app_session_token[-4:]}, using current token until it expires.")
+                return session_data
+            if refresh_not_admitted or get_circuit_breaker("spotify_accounts").state != "closed":
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Spotify is currently unavailable. Please try again shortly.",
+                )
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Could not refresh Spotify token. Please log in again.",
@@ -58,15 +108,30 @@ async def get_current_active_session(request: Request) -> dict:
             )
         print(f"Spotify token refreshed successfully for session {app_session_token[:4]}...{app_session_token[-4:]}")
 
+    # Hand the client a cookie carrying the current access token so it can skip Redis again
+    if is_stateless_mode():
+        request.scope[REISSUED_COOKIE_SCOPE_KEY] = issue_session_token(
+            app_session_token,
+            session_data["spotify_access_token"],
+            session_data["spotify_access_token_expires_at"]
+        )
+
     return session_data 
 
 
+@timed_function("token_refresh")
 async def refresh_spotify_token(spotify_refresh_token: str) -> Optional[dict]:
     if not spotify_refresh_token:
         return None
+
+    breaker = get_circuit_breaker("spotify_accounts")
+    if not breaker.allow_request():
+        print("Skipping Spotify token refresh, circuit breaker is open.")
+        return None
     
-    async with httpx.AsyncClient() as client:
+    async with httpx.AsyncClient(timeout=settings.SPOTIFY_TIMEOUT_SECONDS) as client:
         try:
+            await acquire_spotify_quota()
             response = await client.post(
                 settings.TOKEN_URL,
                 data={
@@ -77,6 +142,7 @@ async def refresh_spotify_token(spotify_refresh_token: str) -> Optional[dict]:
                 },
             )
             response.raise_for_status() 
+            breaker.record_success()
             token_data = response.json()
 
             if "error" in token_data:
@@ -88,9 +154,21 @@ async def refresh_spotify_token(spotify_refresh_token: str) -> Optional[dict]:
                 return None
 
             return token_data
+        except QuotaExceededError:
+            # Never reached Spotify: free a half-open breaker's probe and let the caller answer 503
+            breaker.release_trial()
+            raise
         except httpx.HTTPStatusError as exc:
+            if exc.response.status_code == 429:
+                drain_spotify_quota(float(exc.response.headers.get("Retry-After", "1")))
+            if is_upstream_failure(exc):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
             print(f"HTTP error during Spotify token refresh: {exc.response.status_code} - {exc.response.text}")
             return None
         except Exception as e:
+            if is_upstream_failure(e):
+                breaker.record_failure()
             print(f"Unexpected error during Spotify token refresh: {str(e)}")
             return None
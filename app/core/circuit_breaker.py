@@ -0,0 +1,92 @@
+import time
+import httpx
+from typing import Dict
+from app.core.config import settings
+
+
+class UpstreamUnavailableError(Exception):
+    """Raised when an upstream (Spotify) call fails or is short-circuited"""
+
+
+class CircuitOpenError(UpstreamUnavailableError):
+    """Raised when a call is rejected because its circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """In-process circuit breaker for one family of upstream endpoints.
+
+    closed    -> calls go through, consecutive failures are counted
+    open      -> calls are rejected until reset_timeout has passed
+    half_open -> a single trial call is let through to probe the upstream
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failure_count = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        self._trial_started_at = 0.0
+
+    def allow_request(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = "half_open"
+            self._trial_in_flight = False
+        # half_open: only one probe at a time (a probe that never reported back is given up on)
+        if self._trial_in_flight and time.monotonic() - self._trial_started_at < self.reset_timeout:
+            return False
+        self._trial_in_flight = True
+        self._trial_started_at = time.monotonic()
+        return True
+
+    def record_success(self):
+        if self.state != "closed":
+            print(f"Circuit breaker '{self.name}' closed after successful trial call.")
+        self.state = "closed"
+        self.failure_count = 0
+        self._trial_in_flight = False
+
+    def release_trial(self):
+        """Give back a half-open probe that never reached the upstream (e.g. not admitted by our own quota)"""
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.failure_count += 1
+        self._trial_in_flight = False
+        if self.state == "half_open" or self.failure_count >= self.failure_threshold:
+            if self.state != "open":
+                print(f"Circuit breaker '{self.name}' opened after {self.failure_count} failure(s).")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def check(self):
+        """Raise CircuitOpenError if a call may not be made right now"""
+        if not self.allow_request():
+            raise CircuitOpenError(f"Circuit breaker '{self.name}' is open")
+
+
+def is_upstream_failure(exc: Exception) -> bool:
+    """Whether an exception means the upstream itself is unhealthy (as opposed to a bad request/token)"""
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code >= 500 or exc.response.status_code == 429
+    return isinstance(exc, (httpx.TimeoutException, httpx.TransportError))
+
+
+# One breaker per Spotify endpoint family
+_breakers: Dict[str, CircuitBreaker] = {}
+
+def get_circuit_breaker(name: str) -> CircuitBreaker:
+    """Get (or create) the circuit breaker for an endpoint family, e.g. "spotify_api" or "spotify_accounts"."""
+    if name not in _breakers:
+        _breakers[name] = CircuitBreaker(
+            name,
+            failure_threshold=settings.CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+            reset_timeout=settings.CIRCUIT_BREAKER_RESET_SECONDS,
+        )
+    return _breakers[name]
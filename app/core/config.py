@@ -1,3 +1,4 @@
+from pydantic import field_validator, ValidationInfo
 from pydantic_settings import BaseSettings
 from typing import List
 import os
@@ -29,11 +30,28 @@ class Settings(BaseSettings):
     REDIS_PORT: int = int(os.getenv("REDIS_PORT", "6379"))
     REDIS_DB: int = int(os.getenv("REDIS_DB", "0"))
     REDIS_PASSWORD: str = os.getenv("REDIS_PASSWORD", "")
+    REDIS_MODE: str = os.getenv("REDIS_MODE", "standalone") # standalone, cluster or sentinel
+    REDIS_SENTINELS: str = os.getenv("REDIS_SENTINELS", "") # Comma-separated host:port list, sentinel mode only
+    REDIS_SENTINEL_MASTER: str = os.getenv("REDIS_SENTINEL_MASTER", "mymaster")
+    REDIS_SENTINEL_PASSWORD: str = os.getenv("REDIS_SENTINEL_PASSWORD", "")
+    REDIS_KEY_PREFIX: str = os.getenv("REDIS_KEY_PREFIX", "melophiliacs")
+    REDIS_KEY_VERSION: int = int(os.getenv("REDIS_KEY_VERSION", "1")) # Bump to move to a fresh key namespace
     
     # Session Configuration
     SESSION_TIMEOUT: int = int(os.getenv("SESSION_TIMEOUT", "3600"))
+    SESSION_MODE: str = os.getenv("SESSION_MODE", "redis") # redis, or stateless for encrypted self-contained session cookies
+    SESSION_SECRET_KEY: str = os.getenv("SESSION_SECRET_KEY", "") # Required in stateless mode
+    SESSION_REVOCATION_CHECK_SECONDS: int = int(os.getenv("SESSION_REVOCATION_CHECK_SECONDS", "30")) # How often a worker re-checks Redis for logout
+    SESSION_REVOCATION_CACHE_SIZE: int = int(os.getenv("SESSION_REVOCATION_CACHE_SIZE", "10000"))
     USER_CACHE_TTL_SECONDS: int = int(os.getenv("USER_CACHE_TTL_SECONDS", "3600")) # 1 hour
+    STALE_CACHE_GRACE_SECONDS: int = int(os.getenv("STALE_CACHE_GRACE_SECONDS", "21600")) # Keep compressed copies of expired caches 6 hours for serve-stale; 0 disables
     
+    # Diagnostics
+    SERVER_TIMING_ENABLED: bool = os.getenv("SERVER_TIMING_ENABLED", "true").lower() == "true"
+    DEBUG_PROFILE_TOKEN: str = os.getenv("DEBUG_PROFILE_TOKEN", "") # Secret for the X-Debug-Profile header; empty disables profiling
+    DEBUG_PROFILE_INTERVAL_SECONDS: float = float(os.getenv("DEBUG_PROFILE_INTERVAL_SECONDS", "0.005"))
+    DEBUG_PROFILE_TOP_STACKS: int = int(os.getenv("DEBUG_PROFILE_TOP_STACKS", "50"))
+
     # CORS Configuration
     CORS_ORIGINS: List[str] = [
         "https://melophiliacs.com",
@@ -46,6 +64,20 @@ class Settings(BaseSettings):
     AUTH_URL: str = "https://accounts.spotify.com/authorize"
     TOKEN_URL: str = "https://accounts.spotify.com/api/token"
     API_BASE_URL: str = "https://api.spotify.com/v1"
+
+    # Spotify Resilience
+    SPOTIFY_TIMEOUT_SECONDS: float = float(os.getenv("SPOTIFY_TIMEOUT_SECONDS", "10"))
+    CIRCUIT_BREAKER_FAILURE_THRESHOLD: int = int(os.getenv("CIRCUIT_BREAKER_FAILURE_THRESHOLD", "5"))
+    CIRCUIT_BREAKER_RESET_SECONDS: float = float(os.getenv("CIRCUIT_BREAKER_RESET_SECONDS", "30"))
+
+    # Spotify Quota (shared token bucket across all workers for our client ID)
+    SPOTIFY_QUOTA_ENABLED: bool = os.getenv("SPOTIFY_QUOTA_ENABLED", "true").lower() == "true"
+    SPOTIFY_QUOTA_RATE_PER_SECOND: float = float(os.getenv("SPOTIFY_QUOTA_RATE_PER_SECOND", "10"))
+    SPOTIFY_QUOTA_BURST: int = int(os.getenv("SPOTIFY_QUOTA_BURST", "30"))
+    SPOTIFY_QUOTA_USER_RATE_PER_SECOND: float = float(os.getenv("SPOTIFY_QUOTA_USER_RATE_PER_SECOND", "4"))
+    SPOTIFY_QUOTA_USER_BURST: int = int(os.getenv("SPOTIFY_QUOTA_USER_BURST", "15"))
+    SPOTIFY_QUOTA_BACKGROUND_RESERVE: float = float(os.getenv("SPOTIFY_QUOTA_BACKGROUND_RESERVE", "0.5")) # Fraction of burst kept for interactive calls
+    SPOTIFY_QUOTA_MAX_WAIT_SECONDS: float = float(os.getenv("SPOTIFY_QUOTA_MAX_WAIT_SECONDS", "20"))
     
     # API Limits
     SAVED_TRACKS_LIMIT: int = 3000
@@ -53,6 +85,39 @@ class Settings(BaseSettings):
     TOP_ARTISTS_COUNT: int = 50
     TOP_ALBUMS_COUNT: int = 50
 
+    # Local Library Snapshots (host-local tier below Redis)
+    SNAPSHOT_STORE_ENABLED: bool = os.getenv("SNAPSHOT_STORE_ENABLED", "true").lower() == "true"
+    SNAPSHOT_DB_PATH: str = os.getenv("SNAPSHOT_DB_PATH", "data/library_snapshots.sqlite3")
+    SNAPSHOT_RETENTION_SECONDS: int = int(os.getenv("SNAPSHOT_RETENTION_SECONDS", "86400")) # 1 day
+    SNAPSHOT_PREWARM_ON_STARTUP: bool = os.getenv("SNAPSHOT_PREWARM_ON_STARTUP", "true").lower() == "true"
+    SNAPSHOT_PREWARM_BATCH_SIZE: int = int(os.getenv("SNAPSHOT_PREWARM_BATCH_SIZE", "100"))
+    SNAPSHOT_PREWARM_LOCK_SECONDS: int = int(os.getenv("SNAPSHOT_PREWARM_LOCK_SECONDS", "300"))
+    SNAPSHOT_PREWARM_CHECK_SECONDS: int = int(os.getenv("SNAPSHOT_PREWARM_CHECK_SECONDS", "30")) # How often to check whether Redis lost the pre-warm (e.g. restarted), 0 = startup only
+
+    # Response Shaping
+    LIKED_TRACKS_PROJECTION_CACHE_MAX: int = int(os.getenv("LIKED_TRACKS_PROJECTION_CACHE_MAX", "8")) # Distinct fields= projections cached per user
+    GZIP_MINIMUM_SIZE: int = int(os.getenv("GZIP_MINIMUM_SIZE", "1024")) # Bytes
+
+    # Library Search
+    SEARCH_MIN_SIMILARITY: float = float(os.getenv("SEARCH_MIN_SIMILARITY", "0.5")) # Share of query trigrams a track must contain
+    SEARCH_RESULTS_LIMIT: int = int(os.getenv("SEARCH_RESULTS_LIMIT", "50"))
+    SEARCH_INDEX_MEMORY_CACHE_SIZE: int = int(os.getenv("SEARCH_INDEX_MEMORY_CACHE_SIZE", "64")) # Decoded indexes kept per worker
+
+    # Session settings are checked at startup rather than failing every authenticated request
+    @field_validator("SESSION_MODE")
+    @classmethod
+    def check_session_mode(cls, value: str) -> str:
+        if value not in ("redis", "stateless"):
+            raise ValueError("SESSION_MODE must be 'redis' or 'stateless'")
+        return value
+
+    @field_validator("SESSION_SECRET_KEY")
+    @classmethod
+    def check_session_secret_key(cls, value: str, info: ValidationInfo) -> str:
+        if info.data.get("SESSION_MODE") == "stateless" and not value:
+            raise ValueError("SESSION_SECRET_KEY must be set when SESSION_MODE is 'stateless'")
+        return value
+
     class Config:
         case_sensitive = True
 
@@ -0,0 +1,48 @@
+import sys
+import threading
+from collections import Counter
+from typing import Optional
+
+
+class SamplingProfiler:
+    """Samples the stack of one thread at a fixed interval from a background thread.
+
+    Meant to be attached to a single request: the event loop thread is sampled, so
+    stacks from other requests served concurrently on the same loop show up too.
+    Output is in collapsed-stack format ("outer;inner;leaf count"), which flame graph
+    tools read directly.
+    """
+
+    def __init__(self, interval_seconds: float, thread_id: Optional[int] = None):
+        self.interval_seconds = interval_seconds
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.samples = Counter()
+        self.sample_count = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval_seconds):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_filename}:{code.co_name}")
+                frame = frame.f_back
+            self.samples[";".join(reversed(stack))] += 1
+            self.sample_count += 1
+
+    def collapsed_stacks(self, limit: int) -> str:
+        """The most frequently sampled stacks, one per line"""
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common(limit))
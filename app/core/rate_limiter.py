@@ -0,0 +1,176 @@
+import asyncio
+import redis
+from typing import List, Optional
+from app.core.config import settings
+from app.core.redis import get_redis, shared_key
+from app.core.circuit_breaker import UpstreamUnavailableError
+from app.core.timing import timed_concurrent
+
+# Priority classes for outbound Spotify calls
+PRIORITY_INTERACTIVE = "interactive"  # A user is waiting on the response
+PRIORITY_BACKGROUND = "background"    # Sync/pre-warm work that can yield to interactive traffic
+
+# All quota buckets share one hash tag: the bucket script touches the global and a
+# per-user bucket together, which in cluster mode requires them to be in one slot
+QUOTA_KEY_TAG = "spotify_quota"
+GLOBAL_BUCKET_KEY = shared_key(QUOTA_KEY_TAG, "global")
+
+
+class QuotaExceededError(UpstreamUnavailableError):
+    """Raised when a Spotify call could not be admitted within SPOTIFY_QUOTA_MAX_WAIT_SECONDS"""
+
+
+# Reserves ARGV[1] calls against the app-wide bucket (KEYS[1]) and, if given, the
+# per-user bucket (KEYS[2]). Buckets may go into debt: each reservation queues behind
+# every earlier one, FIFO, and gets back the seconds each of its calls must wait.
+# A reservation whose last call would wait more than ARGV[3] seconds is refused
+# without taking anything. Uses the Redis clock so every worker sees the same time.
+_RESERVE_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) + tonumber(now_parts[2]) / 1000000
+local calls = tonumber(ARGV[1])
+local reserve = tonumber(ARGV[2])
+local max_wait = tonumber(ARGV[3])
+
+local function refill(key, rate, capacity)
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    return math.min(capacity, tokens + math.max(0, now - ts) * rate)
+end
+
+local function debit(key, tokens, rate, capacity)
+    local remaining = tokens - calls
+    redis.call('HSET', key, 'tokens', tostring(remaining), 'ts', tostring(now))
+    redis.call('EXPIRE', key, math.ceil((capacity - remaining) / rate) + 1)
+end
+
+local global_rate, global_capacity = tonumber(ARGV[4]), tonumber(ARGV[5])
+local global_tokens = refill(KEYS[1], global_rate, global_capacity)
+
+local user_tokens, user_rate, user_capacity
+if #KEYS > 1 then
+    user_rate, user_capacity = tonumber(ARGV[6]), tonumber(ARGV[7])
+    user_tokens = refill(KEYS[2], user_rate, user_capacity)
+end
+
+-- Seconds until the k-th call of this reservation is covered. Lower priorities
+-- must leave `reserve` tokens in the global bucket.
+local function wait_for(k)
+    local wait = math.max(0, (k + reserve - global_tokens) / global_rate)
+    if user_tokens then
+        wait = math.max(wait, (k - user_tokens) / user_rate)
+    end
+    return wait
+end
+
+if wait_for(calls) > max_wait then
+    return {'refused', tostring(wait_for(calls))}
+end
+
+debit(KEYS[1], global_tokens, global_rate, global_capacity)
+if user_tokens then
+    debit(KEYS[2], user_tokens, user_rate, user_capacity)
+end
+
+local waits = {}
+for k = 1, calls do
+    waits[k] = tostring(wait_for(k))
+end
+return waits
+"""
+
+# Spotify answered 429: push the app-wide bucket ARGV[1] seconds further into debt,
+# keeping the debt of reservations already queued, so every worker backs off
+_DRAIN_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) + tonumber(now_parts[2]) / 1000000
+local rate, capacity = tonumber(ARGV[2]), tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local drained = math.min(tokens, 0) - tonumber(ARGV[1]) * rate
+redis.call('HSET', KEYS[1], 'tokens', tostring(drained), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil((capacity - drained) / rate) + 1)
+return 1
+"""
+
+
+def _reserve_for_priority(priority: str) -> float:
+    """Tokens a request of this priority must leave in the global bucket"""
+    if priority == PRIORITY_INTERACTIVE:
+        return 0
+    if priority == PRIORITY_BACKGROUND:
+        return settings.SPOTIFY_QUOTA_BURST * settings.SPOTIFY_QUOTA_BACKGROUND_RESERVE
+    raise ValueError(f"Unknown Spotify quota priority: {priority}")
+
+
+def reserve_spotify_quota(
+    user_key: Optional[str] = None,
+    priority: str = PRIORITY_INTERACTIVE,
+    calls: int = 1
+) -> List[float]:
+    """Reserve quota for a batch of Spotify calls. Returns, per call, the seconds to wait before making it.
+
+    All workers share one app-wide bucket sized to the client ID's rate limit.
+    When user_key is given, the calls must also fit that user's own bucket so one
+    large cold load cannot starve everyone else. Reservations queue FIFO, so the
+    wait reflects the caller's place in line; a batch that could not be admitted
+    within SPOTIFY_QUOTA_MAX_WAIT_SECONDS is refused up front, taking no quota.
+    """
+    if not settings.SPOTIFY_QUOTA_ENABLED or calls <= 0:
+        return [0.0] * max(calls, 0)
+
+    reserve = _reserve_for_priority(priority)
+    keys = [GLOBAL_BUCKET_KEY]
+    args = [
+        calls, reserve, settings.SPOTIFY_QUOTA_MAX_WAIT_SECONDS,
+        settings.SPOTIFY_QUOTA_RATE_PER_SECOND, settings.SPOTIFY_QUOTA_BURST
+    ]
+    if user_key:
+        keys.append(shared_key(QUOTA_KEY_TAG, f"user:{user_key}"))
+        args.extend([settings.SPOTIFY_QUOTA_USER_RATE_PER_SECOND, settings.SPOTIFY_QUOTA_USER_BURST])
+
+    try:
+        redis_client = get_redis()
+        waits = redis_client.register_script(_RESERVE_SCRIPT)(keys=keys, args=args)
+    except redis.RedisError as e:
+        # Never let the limiter itself take the service down
+        print(f"Spotify quota check failed, admitting request: {str(e)}")
+        return [0.0] * calls
+
+    if waits[0] == "refused":
+        raise QuotaExceededError(
+            f"Spotify quota exhausted for {priority} request ({calls} call(s) would wait {float(waits[1]):.1f}s)"
+        )
+    return [float(wait) for wait in waits]
+
+
+async def wait_for_quota_slot(wait_seconds: float):
+    """Sleep until a reserved call's turn"""
+    if wait_seconds <= 0:
+        return
+    # Many page fetches wait here at once, time the wall clock rather than each waiter
+    with timed_concurrent("quota"):
+        await asyncio.sleep(wait_seconds)
+
+
+async def acquire_spotify_quota(user_key: Optional[str] = None, priority: str = PRIORITY_INTERACTIVE):
+    """Reserve quota for a single Spotify call and wait for its turn"""
+    wait_seconds = reserve_spotify_quota(user_key, priority)[0]
+    await wait_for_quota_slot(wait_seconds)
+
+
+def drain_spotify_quota(retry_after_seconds: float):
+    """Spotify answered 429: stop admitting calls from any worker for retry_after_seconds"""
+    if not settings.SPOTIFY_QUOTA_ENABLED:
+        return
+    try:
+        redis_client = get_redis()
+        redis_client.register_script(_DRAIN_SCRIPT)(
+            keys=[GLOBAL_BUCKET_KEY],
+            args=[retry_after_seconds, settings.SPOTIFY_QUOTA_RATE_PER_SECOND, settings.SPOTIFY_QUOTA_BURST]
+        )
+    except redis.RedisError as e:
+        print(f"Could not drain Spotify quota after 429: {str(e)}")
@@ -1,10 +1,36 @@
 import redis
+from redis.cluster import RedisCluster
+from redis.sentinel import Sentinel
 from app.core.config import settings
+from app.core.timing import timed_function
+import base64
 import json
-from typing import Optional, Any
+import time
+import zlib
+from functools import lru_cache, wraps
+from typing import Optional, Any, List, Tuple
 
+@lru_cache(maxsize=1)
 def get_redis():
-    """Get Redis connection"""
+    """Get the shared Redis client for the configured REDIS_MODE"""
+    if settings.REDIS_MODE == "cluster":
+        return RedisCluster(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            password=settings.REDIS_PASSWORD or None,
+            decode_responses=True
+        )
+    if settings.REDIS_MODE == "sentinel":
+        sentinel = Sentinel(
+            [_parse_host_port(address) for address in settings.REDIS_SENTINELS.split(',') if address.strip()],
+            sentinel_kwargs={"password": settings.REDIS_SENTINEL_PASSWORD or None}
+        )
+        return sentinel.master_for(
+            settings.REDIS_SENTINEL_MASTER,
+            db=settings.REDIS_DB,
+            password=settings.REDIS_PASSWORD or None,
+            decode_responses=True
+        )
     return redis.Redis(
         host=settings.REDIS_HOST,
         port=settings.REDIS_PORT,
@@ -13,19 +39,101 @@ def get_redis():
         decode_responses=True
     )
 
+def _parse_host_port(address: str) -> Tuple[str, int]:
+    host, _, port = address.strip().rpartition(':')
+    return host, int(port)
+
+# Key layout: <prefix>:v<version>:{<hash tag>}:<kind>
+# Everything for one session shares the {app_session_token} hash tag, so in cluster mode
+# it lives in one slot and multi-key operations stay single-slot, single round trip.
+# Bumping REDIS_KEY_VERSION moves to a fresh namespace and lets old keys expire.
+def user_key(app_session_token: str, kind: str) -> str:
+    """Redis key for one of a session's entries, e.g. user_key(token, "top_artists")"""
+    return f"{settings.REDIS_KEY_PREFIX}:v{settings.REDIS_KEY_VERSION}:{{{app_session_token}}}:{kind}"
+
+def shared_key(tag: str, kind: str) -> str:
+    """Redis key for app-wide state; keys with the same tag share a cluster slot"""
+    return f"{settings.REDIS_KEY_PREFIX}:v{settings.REDIS_KEY_VERSION}:{{{tag}}}:{kind}"
+
+def _miss_on_redis_error(default: Any = None):
+    """Decorator for cache helpers: treat Redis being unreachable as a cache miss.
+
+    Reads fall through to the snapshot tier or Spotify and writes are skipped, so in
+    stateless session mode a Redis outage degrades to slower responses instead of errors.
+    Session helpers are left alone, a session store that is down must still fail.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            except redis.RedisError as e:
+                print(f"Redis unavailable in {func.__name__}, treating it as a cache miss: {str(e)}")
+                return default
+        return wrapper
+    return decorator
+
+def _set_stale_copy(
+    redis_client, app_session_token: str, kind: str, payload: str, ttl: int, cached_at: Optional[int] = None
+):
+    """Keep a timestamped copy of a cache entry for STALE_CACHE_GRACE_SECONDS past its expiry.
+
+    The copy is stored as "<cached_at>:<base64 zlib payload>": it is only read during an
+    outage, and compressing it keeps a full library's stale copy a fraction of the live one.
+    cached_at defaults to now; pass when the data was fetched if it is older, so Age stays honest.
+    """
+    if settings.STALE_CACHE_GRACE_SECONDS <= 0:
+        return
+    compressed_payload = base64.b64encode(zlib.compress(payload.encode(), 1)).decode()
+    redis_client.setex(
+        user_key(app_session_token, f"stale:{kind}"),
+        ttl + settings.STALE_CACHE_GRACE_SECONDS,
+        f"{cached_at if cached_at is not None else int(time.time())}:{compressed_payload}"
+    )
+
+def _get_stale_copy(app_session_token: str, kind: str) -> Optional[Tuple[Any, int]]:
+    """Fetch the stale copy of a cache entry as (data, age_seconds)"""
+    redis_client = get_redis()
+    data = redis_client.get(user_key(app_session_token, f"stale:{kind}"))
+    if not data:
+        return None
+    try:
+        cached_at, _, compressed_payload = data.partition(":")
+        stale_data = json.loads(zlib.decompress(base64.b64decode(compressed_payload)))
+        age_seconds = max(0, int(time.time()) - int(cached_at))
+    except (ValueError, zlib.error) as e:
+        print(f"Ignoring unreadable stale {kind} copy for session {app_session_token[:4]}...{app_session_token[-4:]}: {str(e)}")
+        return None
+    return stale_data, age_seconds
+
+@timed_function("redis")
 def get_session_data(session_id: str, key: Optional[str] = None) -> Any:
     """Fetch session data from Redis"""
     if not session_id:
         return None
 
     redis_client = get_redis()
-    data = redis_client.get(f"session:{session_id}")
+    data = redis_client.get(user_key(session_id, "session"))
     if not data:
         return None
 
     session_data = json.loads(data)
     return session_data.get(key) if key else session_data
 
+@_miss_on_redis_error()
+def get_session_user_ref(session_id: str) -> Optional[str]:
+    """Fetch the user_ref stored at login, or None if it can't be had (including while Redis is down)"""
+    return get_session_data(session_id, "user_ref")
+
+@timed_function("redis")
+def session_exists(session_id: str) -> bool:
+    """Check that a session has not been deleted (logged out) or expired"""
+    if not session_id:
+        return False
+    redis_client = get_redis()
+    return redis_client.exists(user_key(session_id, "session")) > 0
+
+@timed_function("redis")
 def set_session_data(session_id: str, data: dict) -> bool:
     """Store session data in Redis"""
     if not session_id:
@@ -40,111 +148,336 @@ def set_session_data(session_id: str, data: dict) -> bool:
         data = existing_data
 
     redis_client.setex(
-        f"session:{session_id}",
+        user_key(session_id, "session"),
         settings.SESSION_TIMEOUT,
         json.dumps(data)
     )
     return True 
 
-def set_user_tracks_cache(app_session_token: str, tracks: list, ttl: int):
-    """Store user saved songs in Redis"""
+@_miss_on_redis_error(False)
+@timed_function("redis")
+def set_user_tracks_cache(
+    app_session_token: str, tracks: list, ttl: int, version: Optional[str] = None, cached_at: Optional[int] = None
+):
+    """Store user saved songs in Redis, with the library version when it is known.
+
+    cached_at is when the tracks were fetched from Spotify, if not just now (e.g. from a snapshot).
+    """
 
     redis_client = get_redis()
-    redis_client.setex(
-        f"user_tracks:{app_session_token}",
-        ttl,
-        json.dumps(tracks)
-    )
+    payload = json.dumps(tracks)
+    pipe = redis_client.pipeline()
+    pipe.setex(user_key(app_session_token, "user_tracks"), ttl, payload)
+    if version:
+        pipe.setex(user_key(app_session_token, "user_tracks_version"), ttl, version)
+    else:
+        pipe.delete(user_key(app_session_token, "user_tracks_version"))
+    _set_stale_copy(pipe, app_session_token, "user_tracks", payload, ttl, cached_at)
+    # Projections were computed from the previous library, drop them
+    pipe.delete(user_key(app_session_token, "user_tracks_fields"))
+    pipe.execute()
     return True 
 
+# A user's (not a session's) last fetched library, restored from the hosts' snapshots.
+# Sessions find it through the user_ref stored in their session data at login.
+def _user_library_key(user_ref: str) -> str:
+    return shared_key(f"user:{user_ref}", "library")
+
+@timed_function("redis")
+def restore_user_libraries(entries: List[Tuple[str, str, str, int]], ttl: int) -> int:
+    """Bulk-restore (user_ref, library JSON, version, synced_at) entries as user-level libraries.
+
+    A library already restored from a newer snapshot (e.g. by another host) is kept.
+    Returns the number of libraries restored.
+    """
+    now = int(time.time())
+    entries = [entry for entry in entries if entry[3] + ttl > now]
+    if not entries:
+        return 0
+
+    redis_client = get_redis()
+    pipe = redis_client.pipeline()
+    for user_ref, _payload, _version, _synced_at in entries:
+        pipe.hget(_user_library_key(user_ref), "synced_at")
+    newer_entries = [
+        entry for entry, restored_synced_at in zip(entries, pipe.execute())
+        if restored_synced_at is None or int(restored_synced_at) < entry[3]
+    ]
+    if not newer_entries:
+        return 0
+
+    pipe = redis_client.pipeline()
+    for user_ref, payload, version, synced_at in newer_entries:
+        key = _user_library_key(user_ref)
+        pipe.hset(key, mapping={"tracks": payload, "version": version, "synced_at": synced_at})
+        pipe.expire(key, synced_at + ttl - now)
+    pipe.execute()
+    return len(newer_entries)
+
+@_miss_on_redis_error()
+@timed_function("redis")
+def get_user_library(user_ref: str, newer_than: Optional[int] = None) -> Optional[dict]:
+    """Fetch a user's restored library as {"tracks", "version", "synced_at"}.
+
+    With newer_than, returns None without loading the tracks unless the library was synced after it.
+    """
+    if not user_ref:
+        return None
+    redis_client = get_redis()
+    key = _user_library_key(user_ref)
+    if newer_than is not None:
+        synced_at = redis_client.hget(key, "synced_at")
+        if synced_at is None or int(synced_at) <= newer_than:
+            return None
+    payload, version, synced_at = redis_client.hmget(key, "tracks", "version", "synced_at")
+    if payload is None:
+        return None
+    return {"tracks": json.loads(payload), "version": version, "synced_at": int(synced_at)}
+
+@timed_function("redis")
+def delete_user_library(user_ref: str):
+    """Delete a user's restored library from Redis"""
+    if not user_ref:
+        return False
+    redis_client = get_redis()
+    redis_client.delete(_user_library_key(user_ref))
+    return True
+
+@timed_function("redis")
+def try_acquire_lock(name: str, ttl: int) -> bool:
+    """Take a simple expiring lock shared by every worker, without waiting"""
+    redis_client = get_redis()
+    return bool(redis_client.set(shared_key("locks", name), str(int(time.time())), ex=ttl, nx=True))
+
+# Markers have no TTL: they only disappear with Redis' data (restart, failover to an
+# empty replica, flush), which is how a lost pre-warm is noticed
+@timed_function("redis")
+def marker_exists(name: str) -> bool:
+    """Check for a marker set with set_marker"""
+    redis_client = get_redis()
+    return redis_client.exists(shared_key("markers", name)) > 0
+
+@timed_function("redis")
+def set_marker(name: str):
+    """Leave a marker in Redis that lasts as long as its data"""
+    redis_client = get_redis()
+    redis_client.set(shared_key("markers", name), str(int(time.time())))
+    return True
+
+@_miss_on_redis_error()
+@timed_function("redis")
 def get_user_tracks_cache(app_session_token: str) -> Optional[list]:
     """Fetch user saved songs from Redis"""
 
     redis_client = get_redis()
-    data = redis_client.get(f"user_tracks:{app_session_token}")
+    data = redis_client.get(user_key(app_session_token, "user_tracks"))
     if not data:
         return None
     print(f"DEBUG: Fetching user tracks from Redis for session {app_session_token[:4]}...{app_session_token[-4:]}") # Mask the session token
     return json.loads(data)
 
+@_miss_on_redis_error()
+@timed_function("redis")
+def get_user_tracks_version(app_session_token: str) -> Optional[str]:
+    """Fetch the version of the cached user saved songs, without loading them"""
+    if not app_session_token:
+        return None
+    redis_client = get_redis()
+    return redis_client.get(user_key(app_session_token, "user_tracks_version"))
+
+@_miss_on_redis_error()
+@timed_function("redis")
+def get_stale_user_tracks_cache(app_session_token: str) -> Optional[Tuple[list, int]]:
+    """Fetch expired-but-retained user saved songs from Redis as (data, age_seconds)"""
+    if not app_session_token:
+        return None
+    return _get_stale_copy(app_session_token, "user_tracks")
+
+@timed_function("redis")
 def delete_user_tracks_cache(app_session_token: str):
     """Delete user saved songs from Redis cache"""
     redis_client = get_redis()
-    redis_client.delete(f"user_tracks:{app_session_token}")
+    redis_client.delete(
+        user_key(app_session_token, "user_tracks"),
+        user_key(app_session_token, "user_tracks_version"),
+        user_key(app_session_token, "user_tracks_fields"),
+        user_key(app_session_token, "stale:user_tracks")
+    )
     return True 
 
+@_miss_on_redis_error(False)
+@timed_function("redis")
+def set_user_tracks_projection_cache(app_session_token: str, fields: str, payload: str, max_projections: int) -> bool:
+    """Store a serialized fields= projection of the user's saved songs in Redis"""
+    if not app_session_token or not fields:
+        return False
+    redis_client = get_redis()
+    key = user_key(app_session_token, "user_tracks_fields")
+
+    pipe = redis_client.pipeline()
+    pipe.ttl(user_key(app_session_token, "user_tracks"))
+    pipe.hexists(key, fields)
+    pipe.hlen(key)
+    tracks_ttl, projection_exists, projection_count = pipe.execute()
+
+    # Projections live only as long as the library they were computed from
+    if tracks_ttl is None or tracks_ttl <= 0:
+        return False
+
+    # Only keep a handful of distinct projections per user
+    if not projection_exists and projection_count >= max_projections:
+        return False
+
+    pipe = redis_client.pipeline()
+    pipe.hset(key, fields, payload)
+    pipe.expire(key, tracks_ttl)
+    pipe.execute()
+    return True
+
+@_miss_on_redis_error()
+@timed_function("redis")
+def get_user_tracks_projection_cache(app_session_token: str, fields: str) -> Optional[str]:
+    """Fetch a serialized fields= projection of the user's saved songs from Redis"""
+    if not app_session_token or not fields:
+        return None
+    redis_client = get_redis()
+    return redis_client.hget(user_key(app_session_token, "user_tracks_fields"), fields)
+
+@_miss_on_redis_error(False)
+@timed_function("redis")
+def set_library_index(app_session_token: str, version: str, index_payload: str, ttl: int) -> bool:
+    """Store the serialized search index of the user's saved songs in Redis"""
+    if not app_session_token:
+        return False
+    redis_client = get_redis()
+    key = user_key(app_session_token, "user_tracks_index")
+    pipe = redis_client.pipeline()
+    pipe.hset(key, mapping={"version": version, "index": index_payload})
+    pipe.expire(key, ttl)
+    pipe.execute()
+    return True
+
+@_miss_on_redis_error()
+@timed_function("redis")
+def get_library_index_version(app_session_token: str) -> Optional[str]:
+    """Fetch only the library version the user's search index was built from"""
+    if not app_session_token:
+        return None
+    redis_client = get_redis()
+    return redis_client.hget(user_key(app_session_token, "user_tracks_index"), "version")
+
+@_miss_on_redis_error()
+@timed_function("redis")
+def get_library_index(app_session_token: str) -> Optional[str]:
+    """Fetch the serialized search index of the user's saved songs from Redis"""
+    if not app_session_token:
+        return None
+    redis_client = get_redis()
+    return redis_client.hget(user_key(app_session_token, "user_tracks_index"), "index")
+
+@_miss_on_redis_error(False)
+@timed_function("redis")
 def set_top_artists_cache(app_session_token: str, top_artists: list, ttl: int):
     """Store user's top artists in Redis"""
     if not app_session_token:
         return False
     redis_client = get_redis()
-    redis_client.setex(
-        f"top_artists:{app_session_token}",
-        ttl,
-        json.dumps(top_artists)
-    )
+    payload = json.dumps(top_artists)
+    pipe = redis_client.pipeline()
+    pipe.setex(user_key(app_session_token, "top_artists"), ttl, payload)
+    _set_stale_copy(pipe, app_session_token, "top_artists", payload, ttl)
+    pipe.execute()
     return True
 
+@_miss_on_redis_error()
+@timed_function("redis")
 def get_top_artists_cache(app_session_token: str) -> Optional[list]:
     """Fetch user's top artists from Redis"""
     if not app_session_token:
         return None
     redis_client = get_redis()
-    data = redis_client.get(f"top_artists:{app_session_token}")
+    data = redis_client.get(user_key(app_session_token, "top_artists"))
     if not data:
         print(f"DEBUG: No top artists found in Redis cache for session {app_session_token[:4]}...{app_session_token[-4:]}")
         return None
     print(f"DEBUG: Top artists found in Redis cache for session {app_session_token[:4]}...{app_session_token[-4:]}")
     return json.loads(data)
 
+@_miss_on_redis_error()
+@timed_function("redis")
+def get_stale_top_artists_cache(app_session_token: str) -> Optional[Tuple[list, int]]:
+    """Fetch expired-but-retained user's top artists from Redis as (data, age_seconds)"""
+    if not app_session_token:
+        return None
+    return _get_stale_copy(app_session_token, "top_artists")
+
+@timed_function("redis")
 def delete_top_artists_cache(app_session_token: str):
     """Delete user's top artists from Redis"""
     if not app_session_token:
         return False
     redis_client = get_redis()
-    redis_client.delete(f"top_artists:{app_session_token}")
+    redis_client.delete(user_key(app_session_token, "top_artists"), user_key(app_session_token, "stale:top_artists"))
     return True 
 
 # Functions for Top Albums Cache
+@_miss_on_redis_error(False)
+@timed_function("redis")
 def set_top_albums_cache(app_session_token: str, top_albums: list, ttl: int):
     """Store user's top albums in Redis"""
     if not app_session_token:
         return False
     redis_client = get_redis()
-    redis_client.setex(
-        f"top_albums:{app_session_token}",
-        ttl,
-        json.dumps(top_albums)
-    )
+    payload = json.dumps(top_albums)
+    pipe = redis_client.pipeline()
+    pipe.setex(user_key(app_session_token, "top_albums"), ttl, payload)
+    _set_stale_copy(pipe, app_session_token, "top_albums", payload, ttl)
+    pipe.execute()
     return True
 
+@_miss_on_redis_error()
+@timed_function("redis")
 def get_top_albums_cache(app_session_token: str) -> Optional[list]:
     """Fetch user's top albums from Redis"""
     if not app_session_token:
         return None
     redis_client = get_redis()
-    data = redis_client.get(f"top_albums:{app_session_token}")
+    data = redis_client.get(user_key(app_session_token, "top_albums"))
     if not data:
         print(f"DEBUG: No top albums found in Redis cache for session {app_session_token[:4]}...{app_session_token[-4:]}")
         return None
     print(f"DEBUG: Top albums found in Redis cache for session {app_session_token[:4]}...{app_session_token[-4:]}")
     return json.loads(data)
 
+@_miss_on_redis_error()
+@timed_function("redis")
+def get_stale_top_albums_cache(app_session_token: str) -> Optional[Tuple[list, int]]:
+    """Fetch expired-but-retained user's top albums from Redis as (data, age_seconds)"""
+    if not app_session_token:
+        return None
+    return _get_stale_copy(app_session_token, "top_albums")
+
+@timed_function("redis")
 def delete_top_albums_cache(app_session_token: str):
     """Delete user's top albums from Redis"""
     if not app_session_token:
         return False
     redis_client = get_redis()
-    redis_client.delete(f"top_albums:{app_session_token}")
+    redis_client.delete(user_key(app_session_token, "top_albums"), user_key(app_session_token, "stale:top_albums"))
     return True 
 
+@timed_function("redis")
 def delete_session_data(app_session_token: str):
     """Delete session data from Redis"""
     if not app_session_token:
         return False
     redis_client = get_redis()
-    redis_client.delete(f"session:{app_session_token}")
-    redis_client.delete(f"user_tracks:{app_session_token}")
-    redis_client.delete(f"top_artists:{app_session_token}")
-    redis_client.delete(f"top_albums:{app_session_token}")
-    return True 
\ No newline at end of file
+    # All keys share the session's hash tag: one DEL, one slot, one round trip
+    return redis_client.delete(*[
+        user_key(app_session_token, kind)
+        for kind in (
+            "session", "user_tracks", "user_tracks_version", "user_tracks_fields", "user_tracks_index",
+            "top_artists", "top_albums",
+            "stale:user_tracks", "stale:top_artists", "stale:top_albums"
+        )
+    ])
\ No newline at end of file
@@ -0,0 +1,122 @@
+import hashlib
+import time
+import redis
+from jose import jwe, jwt
+from jose.exceptions import JOSEError
+from starlette.datastructures import MutableHeaders
+from starlette.responses import Response
+from typing import Dict, Optional
+from app.core.config import settings
+from app.core.redis import session_exists
+
+SESSION_COOKIE_NAME = "app_session_token"
+
+# Scope key used to hand a re-issued cookie from the auth dependency to SessionCookieMiddleware
+REISSUED_COOKIE_SCOPE_KEY = "reissued_session_cookie"
+
+# Per-worker record of when each session was last confirmed to still exist in Redis
+_revocation_checked_at: Dict[str, float] = {}
+
+
+def is_stateless_mode() -> bool:
+    return settings.SESSION_MODE == "stateless"
+
+def _signing_key() -> str:
+    # Settings refuses to load in stateless mode without a secret
+    return settings.SESSION_SECRET_KEY
+
+def _encryption_key() -> bytes:
+    # A256GCM with direct encryption needs a 32 byte key, derived so only one secret is configured
+    return hashlib.sha256(f"session-encryption:{_signing_key()}".encode()).digest()
+
+def issue_session_token(app_session_token: str, spotify_access_token: str, spotify_access_token_expires_at: int) -> str:
+    """Seal the session id and Spotify access token into a signed (HS256), encrypted (A256GCM) cookie value"""
+    now = int(time.time())
+    signed_token = jwt.encode(
+        {
+            "sid": app_session_token,
+            "sat": spotify_access_token,
+            "sat_exp": spotify_access_token_expires_at,
+            "iat": now,
+            "exp": now + settings.SESSION_TIMEOUT,
+        },
+        _signing_key(),
+        algorithm="HS256",
+    )
+    return jwe.encrypt(signed_token, _encryption_key(), algorithm="dir", encryption="A256GCM").decode()
+
+def decode_session_token(session_token: str) -> Optional[dict]:
+    """Open a cookie value from issue_session_token. Returns None if it was tampered with or has expired."""
+    try:
+        signed_token = jwe.decrypt(session_token, _encryption_key())
+        claims = jwt.decode(signed_token.decode(), _signing_key(), algorithms=["HS256"])
+    except JOSEError:
+        return None
+    if not claims.get("sid") or not claims.get("sat"):
+        return None
+    return claims
+
+def is_session_revoked(app_session_token: str) -> bool:
+    """Whether the session was logged out. Redis is asked at most every SESSION_REVOCATION_CHECK_SECONDS."""
+    now = time.monotonic()
+    checked_at = _revocation_checked_at.get(app_session_token)
+    if checked_at is not None and now - checked_at < settings.SESSION_REVOCATION_CHECK_SECONDS:
+        return False
+
+    try:
+        exists = session_exists(app_session_token)
+    except redis.RedisError as e:
+        # Keep serving reads through a Redis blip, the cookie itself is still authentic
+        print(f"Could not check session revocation, allowing request: {str(e)}")
+        return False
+
+    if not exists:
+        _revocation_checked_at.pop(app_session_token, None)
+        return True
+
+    if len(_revocation_checked_at) >= settings.SESSION_REVOCATION_CACHE_SIZE:
+        _revocation_checked_at.clear()
+    _revocation_checked_at[app_session_token] = now
+    return False
+
+def forget_session(app_session_token: str):
+    """Drop this worker's revocation record so a logged out session is rejected right away"""
+    _revocation_checked_at.pop(app_session_token, None)
+
+def set_session_cookie(response: Response, value: str):
+    response.set_cookie(
+        key = SESSION_COOKIE_NAME,
+        value = value,
+        httponly = True,
+        secure = settings.API_ENV != "development",
+        samesite = "lax",
+        max_age = settings.SESSION_TIMEOUT,
+        path = "/"
+    )
+
+
+class SessionCookieMiddleware:
+    """Sets a session cookie re-issued during the request (e.g. after a token refresh).
+
+    The auth dependency cannot rely on FastAPI merging its Response parameter, since
+    endpoints that return a Response directly skip that merge.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_cookie(message):
+            reissued_cookie = scope.get(REISSUED_COOKIE_SCOPE_KEY)
+            if message["type"] == "http.response.start" and reissued_cookie:
+                cookie_response = Response()
+                set_session_cookie(cookie_response, reissued_cookie)
+                headers = MutableHeaders(scope=message)
+                headers.append("set-cookie", cookie_response.headers["set-cookie"])
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import redis
+import socket
+import sqlite3
+import time
+import zlib
+from contextlib import closing
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from app.core.config import settings
+from app.core.redis import (
+    try_acquire_lock, marker_exists, set_marker, restore_user_libraries, get_user_library, delete_user_library
+)
+
+# Host-local L3 tier below Redis: one SQLite file shared by the workers on a host,
+# holding a zlib-compressed copy of each user's liked tracks library and its sync
+# watermark (when it was fetched, its version, and the newest added_at seen).
+# Snapshots are keyed by a hash of the Spotify user id, never by a session token:
+# they must survive re-logins and Redis restarts, and the file must not hold credentials.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_library_snapshots (
+    user_ref TEXT PRIMARY KEY,
+    version TEXT NOT NULL,
+    track_count INTEGER NOT NULL,
+    latest_added_at TEXT,
+    synced_at INTEGER NOT NULL,
+    payload BLOB NOT NULL
+)
+"""
+
+# Earlier layout keyed by session token: drop it so no session tokens stay on disk
+_LEGACY_TABLE = "library_snapshots"
+
+_initialized = False
+
+
+def user_ref_for(spotify_user_id: str) -> str:
+    """Stable, non-reversible reference to a Spotify user, used to key their snapshots"""
+    return hashlib.sha256(f"library-snapshot:{spotify_user_id}".encode()).hexdigest()
+
+def _connect() -> sqlite3.Connection:
+    """Open the snapshot database, creating it on first use"""
+    global _initialized
+    if not _initialized:
+        os.makedirs(os.path.dirname(os.path.abspath(settings.SNAPSHOT_DB_PATH)), exist_ok=True)
+    connection = sqlite3.connect(settings.SNAPSHOT_DB_PATH, timeout=5)
+    if not _initialized:
+        # WAL lets the other workers on this host read while one writes
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(_SCHEMA)
+        legacy_table = connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (_LEGACY_TABLE,)
+        ).fetchone()
+        connection.commit()
+        if legacy_table:
+            connection.execute(f"DROP TABLE IF EXISTS {_LEGACY_TABLE}")
+            connection.commit()
+            # Also scrub the freed pages the old rows lived in
+            connection.execute("VACUUM")
+        _initialized = True
+    return connection
+
+def save_library_snapshot(user_ref: Optional[str], tracks: List[Dict[str, Any]], version: str) -> bool:
+    """Persist a freshly fetched library with its sync watermark"""
+    if not settings.SNAPSHOT_STORE_ENABLED or not user_ref:
+        return False
+
+    added_at_values = [track_obj.get('added_at') for track_obj in tracks if track_obj.get('added_at')]
+    payload = zlib.compress(json.dumps(tracks, separators=(',', ':')).encode())
+    now = int(time.time())
+    try:
+        with closing(_connect()) as connection, connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO user_library_snapshots "
+                "(user_ref, version, track_count, latest_added_at, synced_at, payload) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_ref, version, len(tracks), max(added_at_values, default=None), now, payload)
+            )
+            connection.execute(
+                "DELETE FROM user_library_snapshots WHERE synced_at < ?",
+                (now - settings.SNAPSHOT_RETENTION_SECONDS,)
+            )
+        return True
+    except sqlite3.Error as e:
+        print(f"Failed to save library snapshot for user {user_ref[:8]}: {str(e)}")
+        return False
+
+def load_library_snapshot(user_ref: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Fetch a user's library snapshot: tracks plus version and synced_at.
+
+    Uses whichever is newer of this host's snapshot and the copy pre-warmed into Redis,
+    so a user who logs in on another host after a Redis restart still finds their library.
+    """
+    if not settings.SNAPSHOT_STORE_ENABLED or not user_ref:
+        return None
+
+    try:
+        with closing(_connect()) as connection:
+            row = connection.execute(
+                "SELECT version, latest_added_at, synced_at, payload FROM user_library_snapshots WHERE user_ref = ?",
+                (user_ref,)
+            ).fetchone()
+    except sqlite3.Error as e:
+        print(f"Failed to load library snapshot for user {user_ref[:8]}: {str(e)}")
+        row = None
+
+    restored_library = get_user_library(user_ref, newer_than=row[2] if row else None)
+    if restored_library is not None:
+        return restored_library
+    if row is None:
+        return None
+
+    version, latest_added_at, synced_at, payload = row
+    return {
+        'tracks': json.loads(zlib.decompress(payload)),
+        'version': version,
+        'latest_added_at': latest_added_at,
+        'synced_at': synced_at,
+    }
+
+def delete_library_snapshot(user_ref: Optional[str]) -> bool:
+    """Remove a user's snapshot and its pre-warmed Redis copy, e.g. on logout"""
+    if not settings.SNAPSHOT_STORE_ENABLED or not user_ref:
+        return False
+    delete_user_library(user_ref)
+    try:
+        with closing(_connect()) as connection, connection:
+            connection.execute("DELETE FROM user_library_snapshots WHERE user_ref = ?", (user_ref,))
+        return True
+    except sqlite3.Error as e:
+        print(f"Failed to delete library snapshot for user {user_ref[:8]}: {str(e)}")
+        return False
+
+def iter_fresh_snapshots(max_age_seconds: int, batch_size: int) -> Iterator[List[Tuple[str, str, str, int]]]:
+    """Yield batches of (user_ref, library JSON, version, synced_at) for snapshots younger than max_age_seconds"""
+    with closing(_connect()) as connection:
+        cursor = connection.execute(
+            "SELECT user_ref, payload, version, synced_at FROM user_library_snapshots "
+            "WHERE synced_at >= ? ORDER BY synced_at DESC",
+            (int(time.time()) - max_age_seconds,)
+        )
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield [
+                (user_ref, zlib.decompress(payload).decode(), version, synced_at)
+                for user_ref, payload, version, synced_at in rows
+            ]
+
+def prewarm_redis_from_snapshots() -> int:
+    """Restore still-fresh libraries into Redis, e.g. after a Redis restart or mass eviction.
+
+    Libraries are restored per user, not per session: a Redis restart also loses the
+    sessions, and the user's next session picks the library up through its user_ref.
+    Only one worker per host does the work; the others see the host lock and skip.
+    Once done, the host leaves a marker in Redis so prewarm_redis_if_needed can tell
+    when Redis has lost its data again.
+    """
+    if not settings.SNAPSHOT_STORE_ENABLED:
+        return 0
+
+    restored = 0
+    try:
+        if not try_acquire_lock(f"prewarm:{socket.gethostname()}", settings.SNAPSHOT_PREWARM_LOCK_SECONDS):
+            return 0
+        for batch in iter_fresh_snapshots(settings.USER_CACHE_TTL_SECONDS, settings.SNAPSHOT_PREWARM_BATCH_SIZE):
+            restored += restore_user_libraries(batch, settings.USER_CACHE_TTL_SECONDS)
+        set_marker(_prewarm_marker_name())
+    except Exception as e:
+        print(f"Redis pre-warm from library snapshots stopped early: {str(e)}")
+    print(f"Pre-warmed {restored} liked tracks libraries in Redis from local snapshots.")
+    return restored
+
+def _prewarm_marker_name() -> str:
+    return f"prewarmed:{socket.gethostname()}"
+
+def prewarm_redis_if_needed() -> int:
+    """Pre-warm Redis unless this host already did since Redis last lost its data.
+
+    Called at startup and then periodically, so a Redis restart is followed by a
+    pre-warm without waiting for the workers to restart.
+    """
+    if not settings.SNAPSHOT_STORE_ENABLED:
+        return 0
+    try:
+        if marker_exists(_prewarm_marker_name()):
+            return 0
+    except redis.RedisError as e:
+        print(f"Could not check whether Redis needs a pre-warm: {str(e)}")
+        return 0
+    return prewarm_redis_from_snapshots()
@@ -0,0 +1,148 @@
+import functools
+import hmac
+import inspect
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, FrozenSet
+from starlette.datastructures import Headers, MutableHeaders
+from app.core.config import settings
+from app.core.profiler import SamplingProfiler
+
+# {metric name: [total seconds, call count]} for the request being served
+_request_timings: ContextVar[Optional[Dict[str, List[float]]]] = ContextVar("request_timings", default=None)
+# Metrics currently being timed, so nested calls (e.g. set_session_data -> get_session_data) count once
+_active_metrics: ContextVar[FrozenSet[str]] = ContextVar("active_metrics", default=frozenset())
+# {metric name: [blocks in flight, when the first of them started]} for timed_concurrent
+_concurrent_blocks: ContextVar[Optional[Dict[str, List[float]]]] = ContextVar("concurrent_blocks", default=None)
+
+
+def record_timing(name: str, seconds: float):
+    """Add a duration to the current request's Server-Timing metric"""
+    timings = _request_timings.get()
+    if timings is None:
+        return
+    entry = timings.setdefault(name, [0.0, 0])
+    entry[0] += seconds
+    entry[1] += 1
+
+@contextmanager
+def timed(name: str):
+    """Time a block into the current request's Server-Timing metric"""
+    active = _active_metrics.get()
+    if name in active or _request_timings.get() is None:
+        yield
+        return
+
+    token = _active_metrics.set(active | {name})
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(name, time.perf_counter() - start)
+        _active_metrics.reset(token)
+
+@contextmanager
+def timed_concurrent(name: str):
+    """Time a block that may run in several tasks at once (e.g. pages fetched under asyncio.gather).
+
+    Only wall-clock time during which at least one such block is running is added,
+    so overlapping waits are not summed past the request's total. Every block counts as a call.
+    """
+    timings = _request_timings.get()
+    blocks = _concurrent_blocks.get()
+    if timings is None or blocks is None:
+        yield
+        return
+
+    in_flight = blocks.setdefault(name, [0, 0.0])
+    if in_flight[0] == 0:
+        in_flight[1] = time.perf_counter()
+    in_flight[0] += 1
+    try:
+        yield
+    finally:
+        in_flight[0] -= 1
+        entry = timings.setdefault(name, [0.0, 0])
+        entry[1] += 1
+        if in_flight[0] == 0:
+            entry[0] += time.perf_counter() - in_flight[1]
+
+def timed_function(name: str):
+    """Decorator form of timed() for sync and async functions"""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with timed(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def format_server_timing(timings: Dict[str, List[float]], total_seconds: float) -> str:
+    metrics = [
+        f'{name};dur={seconds * 1000:.1f};desc="{int(count)} call{"" if count == 1 else "s"}"'
+        for name, (seconds, count) in timings.items()
+    ]
+    metrics.append(f"total;dur={total_seconds * 1000:.1f}")
+    return ", ".join(metrics)
+
+def _profiling_requested(headers: Headers) -> bool:
+    """The profiler only attaches when the caller presents DEBUG_PROFILE_TOKEN"""
+    if not settings.DEBUG_PROFILE_TOKEN:
+        return False
+    provided_token = headers.get("x-debug-profile", "")
+    return bool(provided_token) and hmac.compare_digest(provided_token, settings.DEBUG_PROFILE_TOKEN)
+
+
+class ServerTimingMiddleware:
+    """Collects per-request timings and emits them as a Server-Timing header.
+
+    Also attaches a sampling profiler to the request when asked to via the
+    X-Debug-Profile header, and logs its collapsed stacks once the request ends.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings = {}
+        timings_token = _request_timings.set(timings)
+        blocks_token = _concurrent_blocks.set({})
+        start = time.perf_counter()
+
+        profiler = None
+        profile_id = None
+        if _profiling_requested(Headers(scope=scope)):
+            profile_id = str(uuid.uuid4())
+            profiler = SamplingProfiler(settings.DEBUG_PROFILE_INTERVAL_SECONDS)
+            profiler.start()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                if settings.SERVER_TIMING_ENABLED:
+                    headers.append("Server-Timing", format_server_timing(timings, time.perf_counter() - start))
+                if profile_id:
+                    headers.append("X-Profile-Id", profile_id)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_timings.reset(timings_token)
+            _concurrent_blocks.reset(blocks_token)
+            if profiler is not None:
+                profiler.stop()
+                print(f"PROFILE {profile_id} {scope.get('method')} {scope.get('path')} ({profiler.sample_count} samples):\n{profiler.collapsed_stacks(settings.DEBUG_PROFILE_TOP_STACKS)}")
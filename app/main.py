@@ -1,13 +1,18 @@
 from fastapi import FastAPI, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import JSONResponse
 import httpx
 from typing import Optional
 import os
 from dotenv import load_dotenv
+import asyncio
 
 from app.core.config import settings
 from app.core.redis import get_redis
+from app.core.timing import ServerTimingMiddleware
+from app.core.session_tokens import SessionCookieMiddleware
+from app.core.snapshot_store import prewarm_redis_if_needed
 from app.api.v1.router import api_router
 
 # Load environment variables
@@ -26,10 +31,47 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "X-Cache-Status", "Age"],
 )
 
+# Sets session cookies re-issued by the auth dependency (stateless session mode)
+app.add_middleware(SessionCookieMiddleware)
+
+# Compress large responses (e.g. full liked tracks library) for clients that accept gzip
+app.add_middleware(GZipMiddleware, minimum_size=settings.GZIP_MINIMUM_SIZE)
+
+# Server-Timing breakdown for every request, opt-in sampling profiler via X-Debug-Profile
+app.add_middleware(ServerTimingMiddleware)
+
 app.include_router(api_router, prefix="/api/v1")
 
+# Background task re-checking whether Redis needs a pre-warm
+_prewarm_task: Optional[asyncio.Task] = None
+
+async def _keep_redis_prewarmed():
+    """Pre-warm at startup, then again whenever Redis has lost the pre-warm (e.g. it restarted)"""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, prewarm_redis_if_needed)
+        except Exception as e:
+            print(f"Redis pre-warm check failed: {str(e)}")
+        if settings.SNAPSHOT_PREWARM_CHECK_SECONDS <= 0:
+            return
+        await asyncio.sleep(settings.SNAPSHOT_PREWARM_CHECK_SECONDS)
+
+@app.on_event("startup")
+async def prewarm_redis():
+    """Refill Redis from this host's library snapshots without holding up startup"""
+    global _prewarm_task
+    if settings.SNAPSHOT_STORE_ENABLED and settings.SNAPSHOT_PREWARM_ON_STARTUP:
+        _prewarm_task = asyncio.create_task(_keep_redis_prewarmed())
+
+@app.on_event("shutdown")
+async def stop_prewarm():
+    if _prewarm_task is not None:
+        _prewarm_task.cancel()
+
 @app.get("/")
 async def root():
     return {"message": "Welcome to Melophiliacs API"}
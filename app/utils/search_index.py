@@ -0,0 +1,190 @@
+import hashlib
+import heapq
+import json
+import math
+import unicodedata
+from collections import Counter, OrderedDict
+from typing import List, Dict, Any, Optional, Set
+from app.core.config import settings
+from app.core.redis import get_library_index, get_library_index_version, set_library_index
+
+# Index layout (JSON-serializable):
+# {
+#     "version": library version the index was built from,
+#     "docs": [[track_id, track_name, [artist names], album_name] or None (removed), ...],
+#     "postings": {trigram: [doc position, ...]},
+#     "live": number of non-removed docs
+# }
+
+# Decoded indexes per worker, so keystrokes don't re-decode the index from Redis
+_index_memory_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+
+def _normalize(text: str) -> str:
+    """Helper to casefold and strip accents so "Beyoncé" matches "beyonce" """
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch)).casefold()
+
+def _trigrams(text: str) -> Set[str]:
+    """Helper to get the trigrams of every word in text. Words are left-padded so prefixes match."""
+    grams = set()
+    for word in _normalize(text).split():
+        padded = f"  {word}"
+        for i in range(len(padded) - 2):
+            grams.add(padded[i:i + 3])
+    return grams
+
+def _doc_trigrams(doc: List[Any]) -> Set[str]:
+    _track_id, name, artists, album = doc
+    return _trigrams(" ".join([name or "", *artists, album or ""]))
+
+def _docs_from_tracks(tracks_data: List[Dict[str, Any]]) -> "OrderedDict[str, List[Any]]":
+    """Helper to pull the searchable fields out of Spotify saved track objects, keyed by track id"""
+    docs = OrderedDict()
+    for track_obj in tracks_data:
+        track = track_obj.get('track')
+        if not track or not isinstance(track, dict) or not track.get('id'):
+            continue
+        docs[track['id']] = [
+            track['id'],
+            track.get('name'),
+            [artist.get('name') for artist in track.get('artists', []) if artist.get('name')],
+            (track.get('album') or {}).get('name'),
+        ]
+    return docs
+
+def library_version(tracks_data: List[Dict[str, Any]]) -> str:
+    """Identify a library by the ordered ids of its saved tracks"""
+    track_ids = [
+        track_obj['track']['id'] for track_obj in tracks_data
+        if isinstance(track_obj.get('track'), dict) and track_obj['track'].get('id')
+    ]
+    return hashlib.sha1("\n".join(track_ids).encode()).hexdigest()[:16]
+
+def build_index(tracks_data: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Build a trigram index over track, artist and album names"""
+    index = {"version": library_version(tracks_data), "docs": [], "postings": {}, "live": 0}
+    for doc in _docs_from_tracks(tracks_data).values():
+        _add_doc(index, doc)
+    return index
+
+def _add_doc(index: Dict[str, Any], doc: List[Any]):
+    position = len(index["docs"])
+    index["docs"].append(doc)
+    index["live"] += 1
+    for gram in _doc_trigrams(doc):
+        index["postings"].setdefault(gram, []).append(position)
+
+def _remove_docs(index: Dict[str, Any], positions: Set[int]):
+    """Helper to drop several docs at once, filtering each affected postings list in a single pass"""
+    affected_grams = set()
+    for position in positions:
+        affected_grams |= _doc_trigrams(index["docs"][position])
+        index["docs"][position] = None
+    for gram in affected_grams:
+        postings = index["postings"].get(gram)
+        if postings is None:
+            continue
+        kept = [position for position in postings if position not in positions]
+        if kept:
+            index["postings"][gram] = kept
+        else:
+            del index["postings"][gram]
+    index["live"] -= len(positions)
+
+def update_index(index: Dict[str, Any], tracks_data: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Apply library changes to an existing index instead of rebuilding it"""
+    new_docs = _docs_from_tracks(tracks_data)
+    existing_positions = {doc[0]: position for position, doc in enumerate(index["docs"]) if doc}
+
+    removed_ids = existing_positions.keys() - new_docs.keys()
+    added_ids = [track_id for track_id in new_docs if track_id not in existing_positions]
+
+    # Mostly removed slots: a fresh build is cheaper and compacts the doc list
+    if len(removed_ids) + (len(index["docs"]) - index["live"]) > max(len(new_docs), 1):
+        return build_index(tracks_data)
+
+    if removed_ids:
+        _remove_docs(index, {existing_positions[track_id] for track_id in removed_ids})
+    for track_id in added_ids:
+        _add_doc(index, new_docs[track_id])
+
+    index["version"] = library_version(tracks_data)
+    return index
+
+def search(index: Dict[str, Any], query: str, limit: int) -> List[Dict[str, Any]]:
+    """Prefix/fuzzy search: rank docs by the share of query trigrams they contain"""
+    query_grams = _trigrams(query)
+    if not query_grams:
+        return []
+
+    hits = Counter()
+    postings = index["postings"]
+    for gram in query_grams:
+        hits.update(postings.get(gram, ()))
+
+    min_hits = math.ceil(len(query_grams) * settings.SEARCH_MIN_SIMILARITY)
+    docs = index["docs"]
+    best = heapq.nsmallest(
+        limit,
+        ((position, count) for position, count in hits.items() if count >= min_hits),
+        key=lambda item: (-item[1], _normalize(docs[item[0]][1]))
+    )
+
+    return [
+        {
+            'track_id': docs[position][0],
+            'track_name': docs[position][1],
+            'artists': docs[position][2],
+            'album_name': docs[position][3],
+            'score': round(count / len(query_grams), 3),
+        }
+        for position, count in best
+    ]
+
+def refresh_library_index(app_session_token: str, tracks_data: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Bring the stored index in line with the user's library, incrementally when possible.
+
+    CPU heavy for large libraries, so callers run it off the event loop.
+    """
+    version = library_version(tracks_data)
+    if get_library_index_version(app_session_token) == version:
+        index = load_library_index(app_session_token)
+        if index is not None:
+            return index
+
+    # Decode our own copy: the one in worker memory may be serving searches right now
+    previous_payload = get_library_index(app_session_token)
+    previous_index = json.loads(previous_payload) if previous_payload else None
+    index = update_index(previous_index, tracks_data) if previous_index else build_index(tracks_data)
+
+    # Outlive the library it was built from, so the next fetch of a changed library can be applied incrementally
+    index_ttl = settings.USER_CACHE_TTL_SECONDS + settings.STALE_CACHE_GRACE_SECONDS
+    set_library_index(app_session_token, version, json.dumps(index), index_ttl)
+    _remember_index(app_session_token, index)
+    return index
+
+def load_library_index(app_session_token: str) -> Optional[Dict[str, Any]]:
+    """Fetch the user's index, from worker memory when its version is still current"""
+    version = get_library_index_version(app_session_token)
+    if version is None:
+        _index_memory_cache.pop(app_session_token, None)
+        return None
+
+    cached_index = _index_memory_cache.get(app_session_token)
+    if cached_index is not None and cached_index["version"] == version:
+        _index_memory_cache.move_to_end(app_session_token)
+        return cached_index
+
+    payload = get_library_index(app_session_token)
+    if payload is None:
+        return None
+    index = json.loads(payload)
+    _remember_index(app_session_token, index)
+    return index
+
+def _remember_index(app_session_token: str, index: Dict[str, Any]):
+    _index_memory_cache[app_session_token] = index
+    _index_memory_cache.move_to_end(app_session_token)
+    while len(_index_memory_cache) > settings.SEARCH_INDEX_MEMORY_CACHE_SIZE:
+        _index_memory_cache.popitem(last=False)
@@ -1,12 +1,40 @@
 import httpx
 import asyncio
+import time
+from fastapi import HTTPException
 from app.core.config import settings
-from app.core.redis import get_user_tracks_cache, set_user_tracks_cache
-from typing import List, Dict, Any
+from app.core.redis import get_user_tracks_cache, set_user_tracks_cache, get_session_user_ref
+from app.core.circuit_breaker import get_circuit_breaker, is_upstream_failure, UpstreamUnavailableError
+from app.core.rate_limiter import (
+    acquire_spotify_quota, reserve_spotify_quota, wait_for_quota_slot, drain_spotify_quota,
+    QuotaExceededError, PRIORITY_INTERACTIVE
+)
+from app.utils.search_index import library_version
+from app.core.snapshot_store import load_library_snapshot, save_library_snapshot, user_ref_for
+from app.core.timing import timed, timed_concurrent
+from typing import List, Dict, Any, Tuple, Callable, Optional
+
+def load_stale_or_unavailable(
+    get_stale_cache: Callable[[str], Optional[Tuple[Any, int]]],
+    app_session_token: str,
+    upstream_exc: UpstreamUnavailableError,
+    context: str
+) -> Tuple[Any, Dict[str, str]]:
+    """Fall back to a stale cache entry while Spotify is down or its breaker is open.
+
+    Returns (data, headers marking the response stale). Raises a 503 if no stale copy is left.
+    """
+    print(f"Spotify unavailable in {context}: {str(upstream_exc)}")
+    stale_entry = get_stale_cache(app_session_token)
+    if stale_entry is None:
+        raise HTTPException(status_code=503, detail="Spotify is currently unavailable. Please try again shortly.")
+    stale_data, age_seconds = stale_entry
+    return stale_data, {"X-Cache-Status": "stale", "Age": str(age_seconds)}
 
 async def fetch_all_liked_tracks(
     spotify_access_token: str, 
-    app_session_token: str 
+    app_session_token: str,
+    priority: str = PRIORITY_INTERACTIVE
 ) -> List[Dict[str, Any]]:
     """Fetch all liked tracks for a user. Also cache the results."""
     
@@ -16,7 +44,106 @@ async def fetch_all_liked_tracks(
         # print(f"DEBUG: Liked tracks for session {app_session_token[:4]}... found in cache.")
         return cached_tracks
 
+    # 2. Redis lost it (eviction/restart, or a new session), try the user's snapshot before Spotify
+    user_ref = get_session_user_ref(app_session_token)
+    with timed("snapshot"):
+        snapshot = load_library_snapshot(user_ref)
+    if snapshot is not None:
+        snapshot_age = int(time.time()) - snapshot['synced_at']
+        if snapshot_age < settings.USER_CACHE_TTL_SECONDS:
+            set_user_tracks_cache(
+                app_session_token, snapshot['tracks'], settings.USER_CACHE_TTL_SECONDS - snapshot_age,
+                snapshot['version'], cached_at=snapshot['synced_at']
+            )
+            return snapshot['tracks']
+        # Too old to serve as is, but one page from Spotify may confirm it is still current
+
     # print(f"DEBUG: Liked tracks for session {app_session_token[:4]}... not in cache. Fetching from Spotify.")
+    # Fail fast while Spotify is known to be unhealthy, callers can fall back to stale data
+    breaker = get_circuit_breaker("spotify_api")
+    breaker.check()
+
+    try:
+        all_tracks_items, effective_total_to_fetch = await _fetch_liked_track_pages(
+            spotify_access_token, app_session_token, priority, snapshot
+        )
+    except QuotaExceededError:
+        # Rejected by our own quota, says nothing about Spotify's health: free a half-open breaker's probe
+        breaker.release_trial()
+        raise
+    except Exception as e:
+        if isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 429:
+            drain_spotify_quota(float(e.response.headers.get("Retry-After", "1")))
+        if is_upstream_failure(e):
+            breaker.record_failure()
+            raise UpstreamUnavailableError(f"Spotify saved tracks fetch failed: {str(e)}") from e
+        # Not Spotify's fault (e.g. revoked token), the upstream is still healthy
+        breaker.record_success()
+        raise
+    breaker.record_success()
+
+    # 8. Cache the results
+    final_tracks_to_cache = all_tracks_items[:effective_total_to_fetch]
+    version = library_version(final_tracks_to_cache)
+    set_user_tracks_cache(app_session_token, final_tracks_to_cache, settings.USER_CACHE_TTL_SECONDS, version)
+
+    # 9. Persist a local snapshot so a Redis eviction/restart doesn't mean refetching from Spotify
+    with timed("snapshot"):
+        save_library_snapshot(user_ref, final_tracks_to_cache, version)
+
+    return final_tracks_to_cache
+
+
+async def fetch_user_ref(spotify_access_token: str) -> Optional[str]:
+    """Look up the Spotify user behind an access token, as the user_ref library snapshots are keyed by.
+
+    Returns None if the lookup fails; the session then simply doesn't use snapshots.
+    """
+    try:
+        async with httpx.AsyncClient(timeout=settings.SPOTIFY_TIMEOUT_SECONDS) as client:
+            await acquire_spotify_quota()
+            with timed_concurrent("spotify"):
+                response = await client.get(
+                    f"{settings.API_BASE_URL}/me", headers={"Authorization": f"Bearer {spotify_access_token}"}
+                )
+            response.raise_for_status()
+            spotify_user_id = response.json().get("id")
+    except (httpx.HTTPError, UpstreamUnavailableError, ValueError) as e:
+        print(f"Could not look up Spotify user for library snapshots: {str(e)}")
+        return None
+    return user_ref_for(spotify_user_id) if spotify_user_id else None
+
+
+def _snapshot_still_current(
+    snapshot: Dict[str, Any], first_page_items: List[Dict[str, Any]], total_from_spotify: int
+) -> bool:
+    """Helper to tell from Spotify's first page whether a library snapshot is still current.
+
+    Saved tracks come newest first, so any save changes the first page and its newest
+    added_at (the snapshot's watermark), and any removal changes the total. Libraries
+    past SAVED_TRACKS_LIMIT are never confirmed: a removal could hide behind the cut-off.
+    """
+    snapshot_tracks = snapshot['tracks']
+    if total_from_spotify > settings.SAVED_TRACKS_LIMIT or total_from_spotify != len(snapshot_tracks):
+        return False
+    newest_added_at = max((item.get('added_at') for item in first_page_items if item.get('added_at')), default=None)
+    if newest_added_at != snapshot.get('latest_added_at'):
+        return False
+    page_track_ids = [(item.get('track') or {}).get('id') for item in first_page_items]
+    snapshot_track_ids = [(item.get('track') or {}).get('id') for item in snapshot_tracks[:len(first_page_items)]]
+    return page_track_ids == snapshot_track_ids
+
+async def _fetch_liked_track_pages(
+    spotify_access_token: str,
+    app_session_token: str,
+    priority: str,
+    snapshot: Optional[Dict[str, Any]] = None
+) -> Tuple[List[Dict[str, Any]], int]:
+    """Fetch saved track pages from Spotify. Returns (items, effective_total_to_fetch).
+
+    Given an older library snapshot, returns its tracks instead of fetching the remaining
+    pages when the first page shows the library has not changed.
+    """
     all_tracks_items = [] 
     limit_per_request = settings.SAVED_TRACKS_LIMIT_PER_REQUEST
     current_offset = 0
@@ -24,15 +151,17 @@ async def fetch_all_liked_tracks(
     # Initialize with max limit, will be refined after first API call
     effective_total_to_fetch = settings.SAVED_TRACKS_LIMIT 
 
-    async with httpx.AsyncClient() as client:
+    async with httpx.AsyncClient(timeout=settings.SPOTIFY_TIMEOUT_SECONDS) as client:
         headers = {"Authorization": f"Bearer {spotify_access_token}"}
         
         # 2. Make initial call to get total and first page
-        initial_response = await client.get(
-            f"{settings.API_BASE_URL}/me/tracks",
-            headers=headers,
-            params={"limit": limit_per_request, "offset": 0}
-        )
+        await acquire_spotify_quota(app_session_token, priority)
+        with timed_concurrent("spotify"):
+            initial_response = await client.get(
+                f"{settings.API_BASE_URL}/me/tracks",
+                headers=headers,
+                params={"limit": limit_per_request, "offset": 0}
+            )
         initial_response.raise_for_status()
         initial_data = initial_response.json()
         
@@ -45,18 +174,20 @@ async def fetch_all_liked_tracks(
         all_tracks_items.extend(current_page_items)
         current_offset = len(all_tracks_items)
 
-        # 4. Return if first page already covers all tracks to fetch
+        # 4. Return if first page already covers all tracks to fetch, or confirms the snapshot
+        if snapshot is not None and _snapshot_still_current(snapshot, current_page_items, total_from_spotify):
+            return list(snapshot['tracks']), effective_total_to_fetch
         if current_offset >= effective_total_to_fetch:
-            tracks_to_cache = all_tracks_items[:effective_total_to_fetch]
-            set_user_tracks_cache(app_session_token, tracks_to_cache, settings.USER_CACHE_TTL_SECONDS)
-            return tracks_to_cache
+            return all_tracks_items, effective_total_to_fetch
 
-        tasks = []
-        async def fetch_page(offset_val: int, page_limit: int):
+        async def fetch_page(offset_val: int, page_limit: int, quota_wait_seconds: float):
             page_params = {"limit": page_limit, "offset": offset_val}
-            page_response = await client.get(
-                f"{settings.API_BASE_URL}/me/tracks", headers=headers, params=page_params
-            )
+            await wait_for_quota_slot(quota_wait_seconds)
+            # Quota waits are timed separately, "spotify" only covers calls in flight
+            with timed_concurrent("spotify"):
+                page_response = await client.get(
+                    f"{settings.API_BASE_URL}/me/tracks", headers=headers, params=page_params
+                )
             page_response.raise_for_status()
             return page_response.json().get("items", [])
 
@@ -67,17 +198,23 @@ async def fetch_all_liked_tracks(
             offsets_to_fetch.append(temp_offset)
             temp_offset += limit_per_request
         
-        # 6. Fetch remaining pages concurrently
-        if offsets_to_fetch:
-            for offset_val in offsets_to_fetch:
-                tasks.append(fetch_page(offset_val, limit_per_request))
-            
-            results_from_other_pages = await asyncio.gather(*tasks)
-            for page_items in results_from_other_pages:
-                all_tracks_items.extend(page_items)
-
-    # 7. Cache the results
-    final_tracks_to_cache = all_tracks_items[:effective_total_to_fetch]
-    set_user_tracks_cache(app_session_token, final_tracks_to_cache, settings.USER_CACHE_TTL_SECONDS)
+        # 6. Reserve quota for every remaining page at once: the load queues as one, and if it
+        #    can't be admitted in time it is refused before spending any quota
+        quota_waits = reserve_spotify_quota(app_session_token, priority, calls=len(offsets_to_fetch))
+
+        # 7. Fetch remaining pages concurrently, each at its reserved time
+        page_tasks = [
+            asyncio.ensure_future(fetch_page(offset_val, limit_per_request, quota_wait_seconds))
+            for offset_val, quota_wait_seconds in zip(offsets_to_fetch, quota_waits)
+        ]
+        try:
+            results_from_other_pages = await asyncio.gather(*page_tasks)
+        except BaseException:
+            # One failed page fails the load, don't leave its siblings calling Spotify
+            for task in page_tasks:
+                task.cancel()
+            raise
+        for page_items in results_from_other_pages:
+            all_tracks_items.extend(page_items)
 
-    return final_tracks_to_cache 
\ No newline at end of file
+    return all_tracks_items, effective_total_to_fetch 
\ No newline at end of file